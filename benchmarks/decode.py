@@ -0,0 +1,67 @@
+"""
+Decode throughput benchmark over a synthetic set of JPEG tiles.
+
+python3 benchmarks/decode.py --nimages 256 --size 256 1024 --decoders pil pil_draft torchvision
+"""
+import time
+import torch
+import argparse
+import tempfile
+import numpy as np
+
+from PIL import Image
+from pathlib import Path
+
+from dino.data import get_decoder
+from dino.data.augmentations import MaybeToTensor
+
+
+def make_jpegs(output_dir, nimages, size, quality):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(nimages):
+        # smooth random content compresses like real tiles better than white noise
+        low = rng.integers(0, 256, (size // 16, size // 16, 3), dtype=np.uint8)
+        img = Image.fromarray(low).resize((size, size), Image.BICUBIC)
+        fp = Path(output_dir, f"{i:05}.jpg")
+        img.save(fp, quality=quality)
+        paths.append(fp)
+    return paths
+
+
+def run(paths, decoder, min_size):
+    decode = get_decoder(decoder, min_size)
+    to_tensor = MaybeToTensor()
+    start = time.perf_counter()
+    for fp in paths:
+        img = to_tensor(decode(str(fp)))
+    elapsed = time.perf_counter() - start
+    return len(paths) / elapsed, tuple(img.shape)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nimages", type=int, default=256)
+    parser.add_argument("--size", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument("--min_size", type=int, default=224)
+    parser.add_argument(
+        "--decoders", type=str, nargs="+", default=["pil", "pil_draft", "torchvision"]
+    )
+    parser.add_argument("--num_threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    for size in args.size:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = make_jpegs(tmp_dir, args.nimages, size, args.quality)
+            for decoder in args.decoders:
+                run(paths[:8], decoder, args.min_size)  # warmup
+                throughput, shape = run(paths, decoder, args.min_size)
+                print(
+                    f"size={size:<5} decoder={decoder:<12} {throughput:8.1f} img/s (decoded to tensor {list(shape)})"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+CPU micro-benchmark of DINOLoss against the reference per-pair implementation.
+
+python3 benchmarks/dino_loss.py --batch_size 16 --ncrops 4 10 --out_dim 4096 65536 [--chunk_size 8192]
+"""
+import time
+import torch
+import argparse
+import torch.nn.functional as F
+
+from dino.components import DINOLoss
+
+
+def reference_loss(dino_loss, student_output, teacher_output, epoch):
+    # per-pair double loop DINOLoss.forward used to run (center update left out)
+    student_out = student_output / dino_loss.student_temp
+    student_out = student_out.chunk(dino_loss.ncrops)
+    temp = dino_loss.teacher_temp_schedule[epoch]
+    teacher_out = F.softmax((teacher_output - dino_loss.center) / temp, dim=-1)
+    teacher_out = teacher_out.detach().chunk(2)
+    total_loss = 0
+    n_loss_terms = 0
+    for iq, q in enumerate(teacher_out):
+        for v in range(len(student_out)):
+            if v == iq:
+                continue
+            loss = torch.sum(-q * F.log_softmax(student_out[v], dim=-1), dim=-1)
+            total_loss += loss.mean()
+            n_loss_terms += 1
+    total_loss /= n_loss_terms
+    return total_loss
+
+
+def timeit(fn, niter):
+    fn()  # warmup
+    start = time.perf_counter()
+    for _ in range(niter):
+        fn()
+    return (time.perf_counter() - start) / niter
+
+
+def main(args):
+    torch.manual_seed(0)
+    torch.set_num_threads(args.num_threads)
+    print(
+        f"{'ncrops':>6} {'out_dim':>8} {'reference (ms)':>15} {'dino_loss (ms)':>15} {'speedup':>8} {'max abs diff':>13}"
+    )
+    for ncrops in args.ncrops:
+        for out_dim in args.out_dim:
+            dino_loss = DINOLoss(
+                out_dim, ncrops, 0.04, 0.04, 0, 1, chunk_size=args.chunk_size
+            )
+            dino_loss.center.normal_()
+            # keep the center fixed so that both implementations see the same one
+            dino_loss.update_center = lambda _: None
+            student_output = torch.randn(
+                ncrops * args.batch_size, out_dim, requires_grad=True
+            )
+            teacher_output = torch.randn(2 * args.batch_size, out_dim)
+
+            ref = reference_loss(dino_loss, student_output, teacher_output, 0)
+            (ref_grad,) = torch.autograd.grad(ref, student_output)
+            out = dino_loss(student_output, teacher_output, 0)
+            (out_grad,) = torch.autograd.grad(out, student_output)
+            diff = max(
+                (ref - out).abs().item(), (ref_grad - out_grad).abs().max().item()
+            )
+
+            def run(fn):
+                def step():
+                    loss = fn(dino_loss, student_output, teacher_output, 0)
+                    loss.backward()
+
+                return step
+
+            t_ref = timeit(run(reference_loss), args.niter)
+            t_new = timeit(run(DINOLoss.forward), args.niter)
+            print(
+                f"{ncrops:>6} {out_dim:>8} {t_ref*1e3:>15.2f} {t_new*1e3:>15.2f} {t_ref/t_new:>7.2f}x {diff:>13.2e}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--ncrops", type=int, nargs="+", default=[4, 10])
+    parser.add_argument("--out_dim", type=int, nargs="+", default=[4096, 65536])
+    parser.add_argument("--chunk_size", type=int, default=None)
+    parser.add_argument("--niter", type=int, default=5)
+    parser.add_argument("--num_threads", type=int, default=torch.get_num_threads())
+    main(parser.parse_args())
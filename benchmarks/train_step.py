@@ -0,0 +1,114 @@
+"""
+CPU benchmark of train_one_epoch with metrics synchronized at every step vs. every sync_every steps.
+
+python3 benchmarks/train_step.py --arch vit_tiny --batch_size 8 --niter 20 --sync_every 1 20
+"""
+import time
+import torch
+import argparse
+
+import dino.models.vision_transformer as vits
+
+from dino.models import MultiCropWrapper
+from dino.components import DINOLoss, TeacherEMA
+from dino.utils import train_one_epoch, get_params_groups, cosine_scheduler
+
+
+class FakeCropsDataset(torch.utils.data.Dataset):
+    def __init__(self, length, global_size, local_size, local_crops_number):
+        self.length = length
+        self.global_size = global_size
+        self.local_size = local_size
+        self.local_crops_number = local_crops_number
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        crops = [torch.randn(3, self.global_size, self.global_size) for _ in range(2)]
+        crops += [
+            torch.randn(3, self.local_size, self.local_size)
+            for _ in range(self.local_crops_number)
+        ]
+        return crops, 0
+
+
+def build(arch, out_dim):
+    student = MultiCropWrapper(
+        vits.__dict__[arch](patch_size=16, drop_path_rate=0.1),
+        vits.DINOHead(vits.__dict__[arch]().embed_dim, out_dim),
+    )
+    teacher = MultiCropWrapper(
+        vits.__dict__[arch](patch_size=16),
+        vits.DINOHead(vits.__dict__[arch]().embed_dim, out_dim),
+    )
+    teacher.load_state_dict(student.state_dict())
+    for p in teacher.parameters():
+        p.requires_grad = False
+    return student, teacher
+
+
+def run(args, sync_every):
+    torch.manual_seed(0)
+    student, teacher = build(args.arch, args.out_dim)
+    ncrops = args.local_crops_number + 2
+    dino_loss = DINOLoss(args.out_dim, ncrops, 0.04, 0.04, 0, 1)
+    optimizer = torch.optim.AdamW(get_params_groups(student))
+    dataset = FakeCropsDataset(
+        args.batch_size * args.niter,
+        args.global_size,
+        args.local_size,
+        args.local_crops_number,
+    )
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size)
+    # materialize batches so that data loading is left out of the timing
+    batches = list(data_loader)
+
+    class Batches(list):
+        batch_size = args.batch_size
+
+    schedule = cosine_scheduler(5e-4, 1e-6, 1, len(batches))
+    start = time.perf_counter()
+    train_one_epoch(
+        student,
+        teacher,
+        TeacherEMA(student, teacher),
+        dino_loss,
+        Batches(batches),
+        optimizer,
+        schedule,
+        cosine_scheduler(0.04, 0.4, 1, len(batches)),
+        cosine_scheduler(0.996, 1, 1, len(batches)),
+        0,
+        1,
+        None,
+        3.0,
+        0,
+        -1,
+        sync_every=sync_every,
+    )
+    return (time.perf_counter() - start) / len(batches)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", type=str, default="vit_tiny")
+    parser.add_argument("--out_dim", type=int, default=4096)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--global_size", type=int, default=224)
+    parser.add_argument("--local_size", type=int, default=96)
+    parser.add_argument("--local_crops_number", type=int, default=8)
+    parser.add_argument("--niter", type=int, default=20)
+    parser.add_argument("--sync_every", type=int, nargs="+", default=[1, 20])
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    for sync_every in args.sync_every:
+        t = run(args, sync_every)
+        print(f"sync_every={sync_every:<4} {t*1e3:8.1f} ms / iteration")
+
+
+if __name__ == "__main__":
+    main()
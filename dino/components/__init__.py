@@ -1,2 +1,3 @@
 from .loss import DINOLoss
+from .ema import TeacherEMA
 from .early_stopping import EarlyStoppingDINO
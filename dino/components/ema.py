@@ -0,0 +1,152 @@
+import functools
+import torch
+import torch.nn as nn
+
+from typing import List, Optional
+
+
+def flatten_parameters(params: List[nn.Parameter], dtype: Optional[torch.dtype] = None):
+    """
+    Move parameters into a single contiguous buffer: each parameter becomes a view into it.
+    """
+    dtype = dtype or params[0].dtype
+    devices = {p.device for p in params}
+    assert len(devices) == 1, f"parameters live on several devices: {devices}"
+    buffer = torch.cat([p.detach().reshape(-1).to(dtype) for p in params])
+    offset = 0
+    for p in params:
+        n = p.numel()
+        p.data = buffer[offset : offset + n].view_as(p)
+        offset += n
+    return buffer
+
+
+def _views(buffer: torch.Tensor, params: List[nn.Parameter]):
+    views, offset = [], 0
+    for p in params:
+        n = p.numel()
+        views.append(buffer[offset : offset + n].view_as(p))
+        offset += n
+    return views
+
+
+def _cast(x, dtype: torch.dtype):
+    # floating point tensors of (nested lists / tuples of) outputs
+    if isinstance(x, torch.Tensor) and x.is_floating_point():
+        return x.to(dtype)
+    if isinstance(x, (list, tuple)):
+        return type(x)(_cast(y, dtype) for y in x)
+    return x
+
+
+def half_precision_forward(module: nn.Module, device_type: str = "cuda"):
+    """
+    Wraps the forward of a module stored in float16, so that calls made outside autocast
+    (e.g. by evaluation code) run under float16 autocast and return float32 outputs.
+    """
+    forward = module.forward
+
+    @functools.wraps(forward)
+    def wrapped(*args, **kwargs):
+        if device_type == "cuda":
+            enabled = torch.is_autocast_enabled()
+        else:
+            enabled = torch.is_autocast_cpu_enabled()
+        if enabled:
+            return forward(*args, **kwargs)
+        with torch.autocast(device_type=device_type, dtype=torch.float16):
+            return _cast(forward(*args, **kwargs), torch.float32)
+
+    module.forward = wrapped
+
+
+class TeacherEMA(object):
+    """
+    Exponential moving average update of the teacher weights from the student weights.
+    Teacher parameters are flattened once into a contiguous buffer and the whole update is a single
+    multi-tensor lerp per step. The teacher can be updated every x iterations only (momentum is then
+    compounded accordingly). With fp32_master, the teacher is stored in half precision while the
+    moving average is accumulated in an fp32 master copy ; the teacher then always runs under
+    float16 autocast (see half_precision_forward).
+    """
+
+    def __init__(
+        self,
+        student: nn.Module,
+        teacher: nn.Module,
+        update_every: int = 1,
+        fp32_master: bool = False,
+    ):
+        self.student_params = list(student.parameters())
+        self.teacher_params = list(teacher.parameters())
+        assert len(self.student_params) == len(
+            self.teacher_params
+        ), "student and teacher should have the same parameters"
+        self.update_every = update_every
+
+        self.master_buffer, self.master_params = None, None
+        if fp32_master:
+            # teacher and student start with the same weights
+            self.master_buffer = torch.cat(
+                [p.detach().reshape(-1).float() for p in self.student_params]
+            )
+            self.master_params = _views(self.master_buffer, self.teacher_params)
+            self.teacher_buffer = flatten_parameters(
+                self.teacher_params, dtype=torch.float16
+            )
+            # direct calls (e.g. evaluation code) would otherwise fail on fp32 inputs
+            half_precision_forward(teacher, self.teacher_buffer.device.type)
+        else:
+            self.teacher_buffer = flatten_parameters(self.teacher_params)
+        self._teacher_versions = self._versions()
+
+    def _versions(self):
+        return [p._version for p in self.teacher_params]
+
+    @torch.no_grad()
+    def sync(self):
+        """
+        Copy teacher weights into the fp32 master copy, e.g. after loading a checkpoint.
+        """
+        if self.master_buffer is not None:
+            self.master_buffer.copy_(self.teacher_buffer)
+        self._teacher_versions = self._versions()
+
+    @torch.no_grad()
+    def update(self, it: int, momentum: float):
+        if (it + 1) % self.update_every != 0:
+            return
+        m = momentum**self.update_every
+        if self.master_buffer is None:
+            target = self.teacher_params
+        else:
+            if self._versions() != self._teacher_versions:
+                # teacher weights were loaded from somewhere else since last update
+                self.sync()
+            target = self.master_params
+        if hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(target, self.student_params, 1 - m)
+        else:
+            torch._foreach_mul_(target, m)
+            torch._foreach_add_(target, self.student_params, alpha=1 - m)
+        if self.master_buffer is not None:
+            # going through the parameters (rather than the flat buffer) bumps their version counter
+            if hasattr(torch, "_foreach_copy_"):
+                torch._foreach_copy_(self.teacher_params, self.master_params)
+            else:
+                for p, master in zip(self.teacher_params, self.master_params):
+                    p.copy_(master)
+        self._teacher_versions = self._versions()
+
+    def state_dict(self):
+        if self.master_buffer is None:
+            return {}
+        return {"master": self.master_buffer}
+
+    def load_state_dict(self, state_dict):
+        if self.master_buffer is not None:
+            if "master" in state_dict:
+                self.master_buffer.copy_(state_dict["master"])
+                self._teacher_versions = self._versions()
+            else:
+                self.sync()
@@ -5,6 +5,114 @@ import torch.nn.functional as F
 import torch.distributed as dist
 
 
+def _logits(x, start, end, temp, center=None):
+    x = x[..., start:end].float()
+    if center is not None:
+        x = x - center[..., start:end]
+    return x / temp
+
+
+def _online_logsumexp(x, temp, chunk_size, center=None):
+    """
+    Logsumexp over the last dimension of (x - center) / temp, computed chunk by chunk.
+    """
+    out_dim = x.shape[-1]
+    running_max = torch.full(x.shape[:-1], float("-inf"), device=x.device)
+    running_sum = torch.zeros(x.shape[:-1], device=x.device)
+    for start in range(0, out_dim, chunk_size):
+        z = _logits(x, start, start + chunk_size, temp, center)
+        new_max = torch.maximum(running_max, z.amax(dim=-1))
+        running_sum = running_sum * torch.exp(running_max - new_max) + torch.exp(
+            z - new_max.unsqueeze(-1)
+        ).sum(dim=-1)
+        running_max = new_max
+    return running_max + torch.log(running_sum)
+
+
+class ChunkedDINOCrossEntropy(torch.autograd.Function):
+    """
+    Mean cross-entropy between teacher and student views (same view pairs excluded),
+    streamed over the prototype dimension: softmax normalizers are computed with an online logsumexp
+    and no [ncrops * B, out_dim] temporary is materialized, neither in forward nor in backward.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        student_output,
+        teacher_output,
+        center,
+        student_temp,
+        teacher_temp,
+        ncrops,
+        chunk_size,
+    ):
+        out_dim = student_output.shape[-1]
+        student = student_output.view(ncrops, -1, out_dim)  # [ncrops, B, out_dim]
+        teacher = teacher_output.view(2, -1, out_dim)  # [2, B, out_dim]
+        with torch.autocast(device_type=student_output.device.type, enabled=False):
+            student_lse = _online_logsumexp(student, student_temp, chunk_size)
+            teacher_lse = _online_logsumexp(teacher, teacher_temp, chunk_size, center)
+
+            # since teacher probabilities sum to 1, the cross-entropy between teacher view iq and student view v
+            # is student_lse[v] - sum_k q[iq, k] * z[v, k], with z the student logits
+            dots = torch.zeros(2, ncrops, student.shape[1], device=student.device)
+            for start in range(0, out_dim, chunk_size):
+                end = start + chunk_size
+                q = torch.exp(
+                    _logits(teacher, start, end, teacher_temp, center)
+                    - teacher_lse.unsqueeze(-1)
+                )
+                z = _logits(student, start, end, student_temp)
+                dots += torch.einsum("tbk,sbk->tsb", q, z)
+            loss = student_lse.unsqueeze(0) - dots  # [2, ncrops, B]
+
+            # we skip cases where student and teacher operate on the same view
+            mask = ~torch.eye(2, ncrops, dtype=torch.bool, device=loss.device)
+            total_loss = loss[mask].mean()
+
+        ctx.save_for_backward(
+            student_output, teacher_output, center, student_lse, teacher_lse
+        )
+        ctx.mask = mask
+        ctx.student_temp = student_temp
+        ctx.teacher_temp = teacher_temp
+        ctx.chunk_size = chunk_size
+        return total_loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        (
+            student_output,
+            teacher_output,
+            center,
+            student_lse,
+            teacher_lse,
+        ) = ctx.saved_tensors
+        ncrops, out_dim = ctx.mask.shape[1], student_output.shape[-1]
+        student = student_output.view(ncrops, -1, out_dim)
+        teacher = teacher_output.view(2, -1, out_dim)
+        grad_student = torch.empty_like(student)
+        with torch.autocast(device_type=student_output.device.type, enabled=False):
+            # d(loss)/dz[v] = (n_teacher[v] * p[v] - sum over teacher views iq != v of q[iq]) / (n_terms * B)
+            weights = ctx.mask.float()  # [2, ncrops]
+            n_teacher = weights.sum(dim=0).view(-1, 1, 1)  # [ncrops, 1, 1]
+            scale = grad_output / (ctx.mask.sum() * student.shape[1] * ctx.student_temp)
+            for start in range(0, out_dim, ctx.chunk_size):
+                end = start + ctx.chunk_size
+                q = torch.exp(
+                    _logits(teacher, start, end, ctx.teacher_temp, center)
+                    - teacher_lse.unsqueeze(-1)
+                )
+                p = torch.exp(
+                    _logits(student, start, end, ctx.student_temp)
+                    - student_lse.unsqueeze(-1)
+                )
+                grad = n_teacher * p - torch.einsum("ts,tbk->sbk", weights, q)
+                grad_student[..., start:end] = grad * scale
+        return grad_student.view_as(student_output), None, None, None, None, None, None
+
+
 class DINOLoss(nn.Module):
     def __init__(
         self,
@@ -16,11 +124,14 @@ class DINOLoss(nn.Module):
         nepochs,
         student_temp=0.1,
         center_momentum=0.9,
+        chunk_size=None,
     ):
         super().__init__()
         self.student_temp = student_temp
         self.center_momentum = center_momentum
         self.ncrops = ncrops
+        # when set, the loss is streamed over chunks of chunk_size prototypes to bound peak memory
+        self.chunk_size = chunk_size
         self.register_buffer("center", torch.zeros(1, out_dim))
         # we apply a warm up for the teacher temperature because
         # a too high temperature makes the training instable at the beginning
@@ -37,26 +148,44 @@ class DINOLoss(nn.Module):
     def forward(self, student_output, teacher_output, epoch):
         """
         Cross-entropy between softmax outputs of the teacher and student networks.
+        The cross-entropies of all (teacher view, student view) pairs are computed with a single contraction.
         """
-        student_out = student_output / self.student_temp
-        student_out = student_out.chunk(self.ncrops)
-
-        # teacher centering and sharpening
         temp = self.teacher_temp_schedule[epoch]
-        teacher_out = F.softmax((teacher_output - self.center) / temp, dim=-1)
-        teacher_out = teacher_out.detach().chunk(2)
-
-        total_loss = 0
-        n_loss_terms = 0
-        for iq, q in enumerate(teacher_out):
-            for v in range(len(student_out)):
-                if v == iq:
-                    # we skip cases where student and teacher operate on the same view
-                    continue
-                loss = torch.sum(-q * F.log_softmax(student_out[v], dim=-1), dim=-1)
-                total_loss += loss.mean()
-                n_loss_terms += 1
-        total_loss /= n_loss_terms
+        out_dim = student_output.shape[-1]
+        if self.chunk_size:
+            total_loss = ChunkedDINOCrossEntropy.apply(
+                student_output,
+                teacher_output.detach(),
+                self.center,
+                self.student_temp,
+                temp,
+                self.ncrops,
+                self.chunk_size,
+            )
+            self.update_center(teacher_output)
+            return total_loss
+
+        # computed in full precision, as the per-pair loss terms were when running under autocast
+        with torch.autocast(device_type=student_output.device.type, enabled=False):
+            # log_softmax is computed once per student view
+            student_out = F.log_softmax(
+                student_output.float() / self.student_temp, dim=-1
+            )
+            student_out = student_out.view(self.ncrops, -1)  # [ncrops, B*out_dim]
+
+            # teacher centering and sharpening
+            teacher_out = F.softmax(
+                (teacher_output.float() - self.center) / temp, dim=-1
+            )
+            teacher_out = teacher_out.detach().view(2, -1)  # [2, B*out_dim]
+            batch_size = teacher_out.shape[1] // out_dim
+
+            # loss[iq, v] = sum over the batch of the cross-entropy between teacher view iq and student view v
+            loss = -torch.mm(teacher_out, student_out.t()) / batch_size  # [2, ncrops]
+
+            # we skip cases where student and teacher operate on the same view
+            mask = ~torch.eye(2, self.ncrops, dtype=torch.bool, device=loss.device)
+            total_loss = loss[mask].mean()
         self.update_center(teacher_output)
         return total_loss
 
@@ -1,7 +1,13 @@
 from .dataset import ImagePretrainingDataset, HierarchicalPretrainingDataset
-from .datasets import ImageFolderWithNameDataset
+from .datasets import ImageFolderWithNameDataset, CachedImageFolder
+from .decoders import get_decoder
+from .loader import get_loader_kwargs
+from .shards import TarShardDataset, ShardWriter, is_shard_dir
+from .feature_store import FeatureStore, FeatureStoreWriter, is_feature_store
 from .augmentations import (
     PatchDataAugmentationDINO,
+    TensorPatchDataAugmentationDINO,
     RegionDataAugmentationDINO,
+    BatchedRegionDataAugmentationDINO,
     make_classification_eval_transform,
 )
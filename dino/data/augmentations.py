@@ -1,5 +1,7 @@
+import math
 import torch
 import random
+import torch.nn as nn
 
 from torchvision import transforms
 from PIL import ImageFilter, ImageOps
@@ -21,6 +23,7 @@ def make_normalize_transform(
 class MaybeToTensor(transforms.ToTensor):
     """
     Convert a ``PIL Image`` or ``numpy.ndarray`` to tensor, or keep as is if already a tensor.
+    uint8 tensors (e.g. decoded with torchvision.io) are converted to float in [0, 1].
     """
 
     def __call__(self, pic):
@@ -31,13 +34,15 @@ class MaybeToTensor(transforms.ToTensor):
             Tensor: Converted image.
         """
         if isinstance(pic, torch.Tensor):
+            if pic.dtype == torch.uint8:
+                return pic.float().div_(255)
             return pic
         return super().__call__(pic)
 
 
 class GaussianBlur(object):
     """
-    Apply Gaussian Blur to the PIL image.
+    Apply Gaussian Blur to the PIL image (or image tensor).
     """
 
     def __init__(self, p=0.5, radius_min=0.1, radius_max=2.0):
@@ -50,16 +55,16 @@ class GaussianBlur(object):
         if not do_it:
             return img
 
-        return img.filter(
-            ImageFilter.GaussianBlur(
-                radius=random.uniform(self.radius_min, self.radius_max)
-            )
-        )
+        radius = random.uniform(self.radius_min, self.radius_max)
+        if isinstance(img, torch.Tensor):
+            kernel_size = 2 * math.ceil(3 * radius) + 1
+            return transforms.functional.gaussian_blur(img, kernel_size, radius)
+        return img.filter(ImageFilter.GaussianBlur(radius=radius))
 
 
 class Solarization(object):
     """
-    Apply Solarization to the PIL image.
+    Apply Solarization to the PIL image (or image tensor).
     """
 
     def __init__(self, p):
@@ -67,6 +72,9 @@ class Solarization(object):
 
     def __call__(self, img):
         if random.random() < self.p:
+            if isinstance(img, torch.Tensor):
+                threshold = 128 if img.dtype == torch.uint8 else 128 / 255
+                return transforms.functional.solarize(img, threshold)
             return ImageOps.solarize(img)
         else:
             return img
@@ -157,6 +165,240 @@ class PatchDataAugmentationDINO(object):
         return crops
 
 
+def _grayscale(x):
+    r, g, b = x.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(-3)
+
+
+def _blend(x1, x2, ratio):
+    return (ratio * x1 + (1.0 - ratio) * x2).clamp_(0.0, 1.0)
+
+
+def _rgb_to_hsv(x):
+    r, g, b = x.unbind(dim=-3)
+    maxc = x.max(dim=-3).values
+    minc = x.min(dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def _hsv_to_rgb(x):
+    # closed form of the piecewise hsv -> rgb conversion: c_n = v - v * s * clamp(min(k, 4 - k), 0, 1)
+    # with k = (n + 6 * h) mod 6 and n = 5, 3, 1 for red, green and blue
+    h, s, v = x.unsqueeze(-3).unbind(dim=-4)
+    n = torch.tensor([5.0, 3.0, 1.0], device=x.device, dtype=x.dtype).view(3, 1, 1)
+    k = torch.remainder(n + 6.0 * h, 6.0)
+    return v - v * s * torch.minimum(k, 4.0 - k).clamp_(0.0, 1.0)
+
+
+def _adjust_brightness(x, factor):
+    return (x * factor).clamp_(0.0, 1.0)
+
+
+def _adjust_contrast(x, factor):
+    mean = _grayscale(x).mean(dim=(-3, -2, -1), keepdim=True)
+    return _blend(x, mean, factor)
+
+
+def _adjust_saturation(x, factor):
+    return _blend(x, _grayscale(x), factor)
+
+
+def _adjust_hue(x, factor):
+    h, s, v = _rgb_to_hsv(x).unbind(dim=-3)
+    h = torch.remainder(h + factor.view(-1, 1, 1), 1.0)
+    return _hsv_to_rgb(torch.stack((h, s, v), dim=-3))
+
+
+class TensorPatchDataAugmentationDINO(object):
+    """
+    Batched tensor counterpart of PatchDataAugmentationDINO, meant to run on device after collation.
+    Takes a uint8 batch [B, 3, H, W] and returns [global crops (2*B), local crops (local_crops_number*B)],
+    crops being ordered crop first, then sample (the grouped layout MultiCropWrapper accepts).
+    Random parameters are drawn independently for every crop, with the same distributions as the PIL pipeline ;
+    crops are resized with bicubic grid sampling (without antialiasing) and color jitter operations are applied
+    in a random order per crop.
+    """
+
+    def __init__(
+        self,
+        global_crops_scale,
+        local_crops_scale,
+        local_crops_number,
+        mean: Sequence[float] = IMAGENET_DEFAULT_MEAN,
+        std: Sequence[float] = IMAGENET_DEFAULT_STD,
+        global_crop_size: int = 224,
+        local_crop_size: int = 96,
+        blur_radius_min: float = 0.1,
+        blur_radius_max: float = 2.0,
+    ):
+        self.global_crops_scale = tuple(global_crops_scale)
+        self.local_crops_scale = tuple(local_crops_scale)
+        self.local_crops_number = local_crops_number
+        self.global_crop_size = global_crop_size
+        self.local_crop_size = local_crop_size
+        self.ratio = (3.0 / 4.0, 4.0 / 3.0)
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        # color jitter: brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1, applied with p=0.8
+        self.jitter_ranges = [(0.6, 1.4), (0.6, 1.4), (0.8, 1.2), (-0.1, 0.1)]
+        self.jitter_ops = [
+            _adjust_brightness,
+            _adjust_contrast,
+            _adjust_saturation,
+            _adjust_hue,
+        ]
+        self.blur_radius_min = blur_radius_min
+        self.blur_radius_max = blur_radius_max
+
+    def _rand(self, n, low, high, device):
+        return torch.empty(n, device=device).uniform_(low, high)
+
+    def crop_boxes(self, n, height, width, scale, device, attempts: int = 10):
+        """
+        Vectorized RandomResizedCrop.get_params: (top, left, height, width) of n crops.
+        """
+        area = height * width
+        target_area = area * torch.empty(n, attempts, device=device).uniform_(*scale)
+        log_ratio = torch.empty(n, attempts, device=device).uniform_(
+            math.log(self.ratio[0]), math.log(self.ratio[1])
+        )
+        aspect_ratio = torch.exp(log_ratio)
+        w = torch.sqrt(target_area * aspect_ratio).round()
+        h = torch.sqrt(target_area / aspect_ratio).round()
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        # keep the first valid attempt, as the sequential sampling would
+        first = valid.float().argmax(dim=1, keepdim=True)
+        w, h = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1)
+        # fallback to central crop
+        in_ratio = width / height
+        if in_ratio < min(self.ratio):
+            fw, fh = width, round(width / min(self.ratio))
+        elif in_ratio > max(self.ratio):
+            fw, fh = round(height * max(self.ratio)), height
+        else:
+            fw, fh = width, height
+        found = valid.any(dim=1)
+        w = torch.where(found, w, torch.full_like(w, fw))
+        h = torch.where(found, h, torch.full_like(h, fh))
+        top = torch.floor(torch.rand(n, device=device) * (height - h + 1))
+        left = torch.floor(torch.rand(n, device=device) * (width - w + 1))
+        top = torch.where(found, top, ((height - h) // 2))
+        left = torch.where(found, left, ((width - w) // 2))
+        return top, left, h, w
+
+    def resized_crops(self, x, ncrops, size, scale):
+        """
+        Random resized crops with random horizontal flip, for every sample at once.
+        Returns [ncrops*B, C, size, size], crop-major.
+        """
+        B, C, H, W = x.shape
+        n = ncrops * B
+        top, left, h, w = self.crop_boxes(n, H, W, scale, x.device)
+        flip = torch.where(torch.rand(n, device=x.device) < 0.5, -1.0, 1.0)
+        theta = torch.zeros(n, 2, 3, device=x.device)
+        theta[:, 0, 0] = w / W * flip
+        theta[:, 0, 2] = (2 * left + w) / W - 1
+        theta[:, 1, 1] = h / H
+        theta[:, 1, 2] = (2 * top + h) / H - 1
+        grid = nn.functional.affine_grid(theta, (n, C, size, size), align_corners=False)
+        # lay the crops of a sample side by side so that a single grid_sample call reads each image once
+        grid = grid.view(ncrops, B, size, size, 2).permute(1, 2, 0, 3, 4)
+        grid = grid.reshape(B, size, ncrops * size, 2)
+        crops = nn.functional.grid_sample(
+            x, grid, mode="bicubic", padding_mode="reflection", align_corners=False
+        )
+        crops = crops.view(B, C, size, ncrops, size).permute(3, 0, 1, 2, 4)
+        return crops.reshape(n, C, size, size).clamp_(0.0, 1.0)
+
+    def color_jitter(self, x, p: float = 0.8):
+        n = x.shape[0]
+        apply = torch.rand(n, device=x.device) < p
+        factors = [self._rand(n, *r, x.device) for r in self.jitter_ranges]
+        # each crop gets its own random order of the 4 operations
+        order = torch.rand(n, 4, device=x.device).argsort(dim=1)
+        for step in range(4):
+            for op_id, op in enumerate(self.jitter_ops):
+                idx = torch.nonzero(apply & (order[:, step] == op_id)).squeeze(1)
+                if len(idx) > 0:
+                    factor = factors[op_id][idx]
+                    if op_id < 3:
+                        factor = factor.view(-1, 1, 1, 1)
+                    x[idx] = op(x[idx], factor)
+        return x
+
+    def random_grayscale(self, x, p: float = 0.2):
+        apply = (torch.rand(x.shape[0], device=x.device) < p).view(-1, 1, 1, 1)
+        return torch.where(apply, _grayscale(x).expand_as(x), x)
+
+    def gaussian_blur(self, x, p: torch.Tensor):
+        """
+        Per-crop gaussian blur with radius uniformly sampled in [blur_radius_min, blur_radius_max],
+        applied with probability p (one value per crop), as a separable grouped convolution.
+        """
+        idx = torch.nonzero(torch.rand(x.shape[0], device=x.device) < p).squeeze(1)
+        if len(idx) == 0:
+            return x
+        n, C, H, W = len(idx), x.shape[1], x.shape[2], x.shape[3]
+        sigma = self._rand(n, self.blur_radius_min, self.blur_radius_max, x.device)
+        radius = int(math.ceil(3 * self.blur_radius_max))
+        radius = min(radius, (min(H, W) - 1))
+        coords = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+        kernel = torch.exp(-(coords**2) / (2 * sigma.view(-1, 1) ** 2))
+        kernel = (kernel / kernel.sum(dim=1, keepdim=True)).repeat_interleave(C, dim=0)
+        y = x[idx].reshape(1, n * C, H, W)
+        y = nn.functional.pad(y, (radius, radius, radius, radius), mode="reflect")
+        y = nn.functional.conv2d(y, kernel.view(n * C, 1, 1, -1), groups=n * C)
+        y = nn.functional.conv2d(y, kernel.view(n * C, 1, -1, 1), groups=n * C)
+        x[idx] = y.view(n, C, H, W)
+        return x
+
+    def solarize(self, x, p: torch.Tensor):
+        apply = (torch.rand(x.shape[0], device=x.device) < p).view(-1, 1, 1, 1)
+        # PIL solarizes pixels >= 128
+        return torch.where(apply & (x >= 128 / 255), 1.0 - x, x)
+
+    def normalize(self, x):
+        mean, std = self.mean.to(x.device), self.std.to(x.device)
+        return (x - mean) / std
+
+    @torch.no_grad()
+    def __call__(self, x):
+        B = x.shape[0]
+        x = x.float() / 255 if x.dtype == torch.uint8 else x.float()
+
+        # global crops: blur with p=1.0 for the first one, p=0.1 and solarization with p=0.2 for the second one
+        global_crops = self.resized_crops(
+            x, 2, self.global_crop_size, self.global_crops_scale
+        )
+        global_crops = self.random_grayscale(self.color_jitter(global_crops))
+        blur_p = torch.tensor([1.0, 0.1], device=x.device).repeat_interleave(B)
+        global_crops = self.gaussian_blur(global_crops, blur_p)
+        solarize_p = torch.tensor([0.0, 0.2], device=x.device).repeat_interleave(B)
+        global_crops = self.solarize(global_crops, solarize_p)
+        crops = [self.normalize(global_crops)]
+
+        if self.local_crops_number > 0:
+            local_crops = self.resized_crops(
+                x, self.local_crops_number, self.local_crop_size, self.local_crops_scale
+            )
+            local_crops = self.random_grayscale(self.color_jitter(local_crops))
+            local_crops = self.gaussian_blur(local_crops, 0.5)
+            crops.append(self.normalize(local_crops))
+        return crops
+
+
 class RegionDataAugmentationDINO(object):
     """
     Modified Data Augmentaton for DINO for [region_size x region_size] resolutions for performing local / global crops on features in image grid
@@ -211,6 +453,57 @@ class RegionDataAugmentationDINO(object):
         return crops
 
 
+class BatchedRegionDataAugmentationDINO(object):
+    """
+    Batch-level counterpart of RegionDataAugmentationDINO, meant to run after collation (ideally on device).
+    Takes a batch of region features, either [B, npatch**2, 384] or [B, 384, npatch, npatch], and returns
+    [global crops (2*B), local crops (local_crops_number*B)], crops being ordered crop first, then sample.
+    Random crop offsets and horizontal flips are drawn per crop and applied with a single gather per crop size.
+    """
+
+    def __init__(
+        self,
+        global_crops_scale,
+        local_crops_number,
+        local_crops_scale,
+        region_size: int = 4096,
+        patch_size: int = 256,
+    ):
+        self.npatch = int(region_size // patch_size)
+        self.global_crop_size = int(global_crops_scale * self.npatch)
+        self.local_crop_size = int(local_crops_scale * self.npatch)
+        self.local_crops_number = local_crops_number
+
+    def random_crops(self, x, ncrops: int, size: int):
+        B, C, H, W = x.shape
+        n = ncrops * B
+        top = torch.randint(0, H - size + 1, (n, 1), device=x.device)
+        left = torch.randint(0, W - size + 1, (n, 1), device=x.device)
+        offsets = torch.arange(size, device=x.device)
+        rows = top + offsets
+        # flipped crops read their columns right to left
+        flip = torch.rand(n, 1, device=x.device) < 0.5
+        cols = left + torch.where(flip, size - 1 - offsets, offsets)
+        sample = torch.arange(B, device=x.device).repeat(ncrops)
+        crops = x[sample[:, None, None], :, rows[:, :, None], cols[:, None, :]]
+        return crops.permute(
+            0, 3, 1, 2
+        ).contiguous()  # [n, size, size, C] -> [n, C, size, size]
+
+    @torch.no_grad()
+    def __call__(self, x):
+        if x.dim() == 3:
+            # [B, npatch**2, 384] -> [B, 384, npatch, npatch]
+            B, _, C = x.shape
+            x = x.view(B, self.npatch, self.npatch, C).permute(0, 3, 1, 2)
+        crops = [self.random_crops(x, 2, self.global_crop_size)]
+        if self.local_crops_number > 0:
+            crops.append(
+                self.random_crops(x, self.local_crops_number, self.local_crop_size)
+            )
+        return crops
+
+
 def make_classification_eval_transform(
     *,
     resize_size: int = 256,
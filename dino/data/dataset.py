@@ -1,18 +1,57 @@
 import torch
+import numpy as np
 import pandas as pd
 
 from PIL import Image
 from pathlib import Path
 from torchvision import datasets
-from typing import Callable, Optional, Any
+from typing import Callable, Optional, Any, Sequence
 from torchvision.datasets.folder import default_loader
 
+from dino.data.feature_store import FeatureStore, is_feature_store
+
 
 def read_image(image_fp: str) -> Image:
     return Image.open(image_fp)
 
 
+class StringTable(object):
+    """
+    Immutable list of strings stored as one uint8 buffer plus offsets.
+    Unlike a list of python strings (or a DataFrame column), the two numpy arrays are not touched by
+    reference counting, so DataLoader workers share the parent process pages instead of copying them.
+    """
+
+    def __init__(self, strings: Sequence[str]):
+        encoded = [str(s).encode("utf-8") for s in strings]
+        lengths = np.fromiter(
+            (len(e) for e in encoded), dtype=np.int64, count=len(encoded)
+        )
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    @classmethod
+    def from_arrays(cls, buffer: np.ndarray, offsets: np.ndarray):
+        table = cls.__new__(cls)
+        table.buffer = buffer
+        table.offsets = offsets
+        return table
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.buffer[start:end].tobytes().decode("utf-8")
+
+
 class ImagePretrainingDataset(torch.utils.data.Dataset):
+    """
+    tiles_df needs a tile_path column (and label_name column if given) ; samples are indexed by position.
+    Columns are converted once to compact arrays, the DataFrame itself is not kept.
+    """
+
     def __init__(
         self,
         tiles_df: pd.DataFrame,
@@ -20,40 +59,65 @@ class ImagePretrainingDataset(torch.utils.data.Dataset):
         loader: Callable[[str], Any] = default_loader,
         label_name: Optional[str] = None,
     ):
-        self.df = tiles_df
+        self.tile_paths = StringTable(tiles_df.tile_path.values)
+        self.labels = None
+        if label_name is not None:
+            labels = tiles_df[label_name].values
+            if labels.dtype == object:
+                self.labels = StringTable(labels)
+            else:
+                self.labels = np.ascontiguousarray(labels)
         self.transform = transform
         self.loader = loader
         self.label_name = label_name
 
     def __getitem__(self, idx: int):
-        row = self.df.loc[idx]
-        path = row.tile_path
+        path = self.tile_paths[idx]
         tile = self.loader(path)
         if self.transform is not None:
             tile = self.transform(tile)
         label = -1
-        if self.label_name is not None:
-            label = row[self.label_name]
+        if self.labels is not None:
+            label = self.labels[idx]
         return tile, label
 
     def __len__(self):
-        return len(self.df)
+        return len(self.tile_paths)
 
 
 class HierarchicalPretrainingDataset(torch.utils.data.Dataset):
+    """
+    features_dir is either a directory of per-region .pt files
+    or a packed feature store (see dino/pack_features.py)
+    if transform is None, raw [npatch**2, 384] features are returned (e.g. to be augmented by batch)
+    """
+
     def __init__(
         self,
         features_dir: str,
-        transform: Callable,
+        transform: Optional[Callable] = None,
     ):
-        self.features_list = [f for f in Path(features_dir).glob("*.pt")]
+        self.store = None
+        self.features_list = None
+        if is_feature_store(features_dir):
+            self.store = FeatureStore(features_dir)
+            self.store.check_written()
+        else:
+            self.features_list = [f for f in Path(features_dir).glob("*.pt")]
         self.transform = transform
 
     def __getitem__(self, idx: int):
-        f = torch.load(self.features_list[idx])
-        f = self.transform(f)
+        if self.store is not None:
+            # zero-copy view on the memory-mapped shard, upcasted if stored in half precision
+            f = self.store[idx].float()
+        else:
+            f = torch.load(self.features_list[idx])
+        if self.transform is not None:
+            f = self.transform(f)
         label = torch.zeros(1, 1)
         return f, label
 
     def __len__(self):
+        if self.store is not None:
+            return len(self.store)
         return len(self.features_list)
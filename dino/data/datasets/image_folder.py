@@ -1,6 +1,16 @@
+import os
+import hashlib
+import numpy as np
+import torch.distributed as dist
+
 from pathlib import Path
 from torchvision import datasets
-from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from torchvision.datasets.folder import default_loader, IMG_EXTENSIONS
+
+from dino.data.dataset import StringTable
+from dino.distributed import is_dist_avail_and_initialized, is_main_process
 
 
 class ImageFolderWithNameDataset(datasets.ImageFolder):
@@ -8,10 +18,12 @@ class ImageFolderWithNameDataset(datasets.ImageFolder):
         self,
         root: str,
         transform: Optional[Callable] = None,
+        loader: Callable[[str], Any] = default_loader,
     ):
         super().__init__(
             root,
             transform,
+            loader=loader,
         )
 
     def __getitem__(self, idx: int):
@@ -28,3 +40,195 @@ class ImageFolderWithNameDataset(datasets.ImageFolder):
         if self.transform is not None:
             sample = self.transform(sample)
         return sample, fname
+
+
+class Manifest(object):
+    """
+    Read-only list of (path, class_index) samples stored as a StringTable plus an int array,
+    which is what ImageFolder expects in self.samples.
+    """
+
+    def __init__(self, paths: StringTable, targets: np.ndarray):
+        self.paths = paths
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx: int) -> Tuple[str, int]:
+        return self.paths[idx], int(self.targets[idx])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def _scan_dir(directory: str, extensions: Tuple[str, ...]):
+    files, subdirs = [], []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.name.lower().endswith(extensions):
+                files.append(entry.path)
+    return files, subdirs
+
+
+def scan_image_folder(
+    directory: str,
+    class_to_idx: Dict[str, int],
+    extensions: Tuple[str, ...] = IMG_EXTENSIONS,
+    num_threads: int = 16,
+) -> Tuple[List[str], List[int]]:
+    """
+    Same listing as ImageFolder, but directories are listed concurrently by a pool of threads
+    (os.scandir releases the GIL, which matters on network filesystems).
+    Paths are sorted within each class.
+    """
+    paths, targets = [], []
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending = {}
+        for target_class, class_index in class_to_idx.items():
+            d = os.path.join(directory, target_class)
+            if os.path.isdir(d):
+                pending[pool.submit(_scan_dir, d, extensions)] = class_index
+        found = {class_index: [] for class_index in class_to_idx.values()}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                class_index = pending.pop(future)
+                files, subdirs = future.result()
+                found[class_index].extend(files)
+                for d in subdirs:
+                    pending[pool.submit(_scan_dir, d, extensions)] = class_index
+    for class_index in sorted(found):
+        files = sorted(found[class_index])
+        paths.extend(files)
+        targets.extend([class_index] * len(files))
+    return paths, targets
+
+
+def manifest_key(
+    directory: str, classes: List[str], extensions: Tuple[str, ...]
+) -> str:
+    """
+    Hash of the mtime and size of the root and class directories ; adding or removing a file
+    directly in one of them changes it (changes in nested sub-directories are not tracked).
+    """
+    h = hashlib.sha1()
+    h.update(repr(extensions).encode())
+    for d in [directory] + [os.path.join(directory, c) for c in classes]:
+        st = os.stat(d)
+        h.update(f"{d}:{st.st_mtime_ns}:{st.st_size}".encode())
+    return h.hexdigest()
+
+
+class CachedImageFolder(datasets.ImageFolder):
+    """
+    ImageFolder whose file listing is cached in cache_dir as a compact binary manifest.
+    The cache is reused as long as the root and class directories are unchanged ; in a distributed
+    session, rank 0 builds it while other ranks wait, then they all read it.
+    If cache_dir is None, the listing is done every time (with a pool of threads).
+    """
+
+    def __init__(
+        self,
+        root: str,
+        transform: Optional[Callable] = None,
+        loader: Callable[[str], Any] = default_loader,
+        cache_dir: Optional[str] = None,
+        num_threads: int = 16,
+    ):
+        self.cache_dir = cache_dir
+        self.num_threads = num_threads
+        self.cache_hit = False
+        super().__init__(
+            root,
+            transform,
+            loader=loader,
+        )
+        # ImageFolder turns targets into a python list, keep the compact array instead
+        self.targets = self.samples.targets
+        self.imgs = self.samples
+
+    def cache_path(self, directory: str) -> Path:
+        name = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:16]
+        return Path(self.cache_dir, f"manifest_{name}.npz")
+
+    def load_manifest(self, cache_path: Path, key: str) -> Optional[Manifest]:
+        if not cache_path.is_file():
+            return None
+        try:
+            with np.load(cache_path) as data:
+                if str(data["key"]) != key:
+                    return None
+                paths = StringTable.from_arrays(data["buffer"], data["offsets"])
+                return Manifest(paths, data["targets"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save_manifest(self, manifest: Manifest, cache_path: Path, key: str):
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                key=np.array(key),
+                buffer=manifest.paths.buffer,
+                offsets=manifest.paths.offsets,
+                targets=manifest.targets,
+            )
+        # atomic, readers never see a partially written file
+        os.replace(tmp_path, cache_path)
+
+    def scan(
+        self,
+        directory: str,
+        class_to_idx: Dict[str, int],
+        extensions: Tuple[str, ...],
+        allow_empty: bool,
+    ) -> Manifest:
+        paths, targets = scan_image_folder(
+            directory, class_to_idx, extensions, self.num_threads
+        )
+        if not allow_empty:
+            empty = set(class_to_idx.values()).difference(targets)
+            if empty:
+                classes = sorted(c for c, i in class_to_idx.items() if i in empty)
+                raise FileNotFoundError(
+                    f"Found no valid file for the classes {', '.join(classes)}. Supported extensions are: {', '.join(extensions)}"
+                )
+        return Manifest(StringTable(paths), np.asarray(targets, dtype=np.int64))
+
+    def make_dataset(
+        self,
+        directory: str,
+        class_to_idx: Dict[str, int],
+        extensions: Optional[Tuple[str, ...]] = None,
+        is_valid_file: Optional[Callable[[str], bool]] = None,
+        allow_empty: bool = False,
+    ) -> Manifest:
+        if is_valid_file is not None:
+            raise ValueError("CachedImageFolder only supports filtering by extension")
+        extensions = tuple(extensions or IMG_EXTENSIONS)
+        if self.cache_dir is None:
+            return self.scan(directory, class_to_idx, extensions, allow_empty)
+
+        key = manifest_key(directory, sorted(class_to_idx), extensions)
+        cache_path = self.cache_path(directory)
+        manifest = None
+        if is_main_process():
+            manifest = self.load_manifest(cache_path, key)
+            self.cache_hit = manifest is not None
+            if manifest is None:
+                manifest = self.scan(directory, class_to_idx, extensions, allow_empty)
+                self.save_manifest(manifest, cache_path, key)
+        if is_dist_avail_and_initialized():
+            dist.barrier()
+        if manifest is None:
+            manifest = self.load_manifest(cache_path, key)
+            self.cache_hit = manifest is not None
+        if manifest is None:
+            # e.g. cache_dir not on a filesystem shared with rank 0
+            manifest = self.scan(directory, class_to_idx, extensions, allow_empty)
+        return manifest
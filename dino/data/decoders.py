@@ -0,0 +1,72 @@
+import io
+import torch
+import torchvision
+
+from PIL import Image
+from typing import Any, Callable, Optional, Union
+from torchvision.datasets.folder import default_loader
+
+
+DECODERS = ["pil", "pil_draft", "torchvision"]
+
+
+def _open(src: Union[str, bytes]):
+    # decoders take either a file path or the encoded bytes (e.g. read from a tar shard)
+    if isinstance(src, bytes):
+        return io.BytesIO(src)
+    return open(src, "rb")
+
+
+def pil_decoder(src: Union[str, bytes]) -> Image.Image:
+    if isinstance(src, str):
+        return default_loader(src)
+    with _open(src) as f:
+        return Image.open(f).convert("RGB")
+
+
+class PILDraftDecoder(object):
+    """
+    Decode JPEG files at reduced size (DCT scaling by 1/2, 1/4 or 1/8), keeping both sides
+    at least min_size pixels ; other formats are decoded at full size.
+    Useful when images are much larger than the crops actually needed.
+    """
+
+    def __init__(self, min_size: int = 224):
+        self.min_size = min_size
+
+    def __call__(self, src: Union[str, bytes]) -> Image.Image:
+        with _open(src) as f:
+            img = Image.open(f)
+            if img.format == "JPEG":
+                img.draft("RGB", (self.min_size, self.min_size))
+            return img.convert("RGB")
+
+
+def torchvision_decoder(src: Union[str, bytes]) -> torch.Tensor:
+    """
+    Decode straight to a [3, H, W] uint8 tensor with torchvision.io (libjpeg-turbo for JPEG files),
+    which skips the PIL image -> tensor conversion.
+    """
+    if isinstance(src, bytes):
+        data = torch.frombuffer(bytearray(src), dtype=torch.uint8)
+    else:
+        data = torchvision.io.read_file(src)
+    return torchvision.io.decode_image(data, mode=torchvision.io.ImageReadMode.RGB)
+
+
+def get_decoder(
+    name: str = "pil", min_size: Optional[int] = None
+) -> Callable[[Union[str, bytes]], Any]:
+    """
+    Returns a decoder taking either an image path or its encoded bytes:
+    - pil: PIL decoding to an RGB image (torchvision default loader)
+    - pil_draft: PIL decoding at reduced size for JPEG files (see PILDraftDecoder)
+    - torchvision: torchvision.io decoding to a uint8 tensor
+    """
+    if name == "pil":
+        return pil_decoder
+    elif name == "pil_draft":
+        return PILDraftDecoder(min_size or 224)
+    elif name == "torchvision":
+        return torchvision_decoder
+    raise ValueError(f"unknown decoder {name}, should be one of {DECODERS}")
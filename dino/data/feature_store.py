@@ -0,0 +1,295 @@
+import json
+import queue
+import torch
+import threading
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from typing import Optional, Sequence
+
+
+INDEX_FILENAME = "index.json"
+MANIFEST_FILENAME = "manifest.csv"
+WRITTEN_FILENAME = "written.npy"
+
+
+def is_feature_store(path) -> bool:
+    return Path(path, INDEX_FILENAME).is_file()
+
+
+def _read_index(store_dir):
+    with open(Path(store_dir, INDEX_FILENAME), "r") as f:
+        return json.load(f)
+
+
+def _write_index(store_dir, index):
+    # write to a temporary file first so that readers never see a partial index
+    tmp_path = Path(store_dir, f"{INDEX_FILENAME}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    tmp_path.replace(Path(store_dir, INDEX_FILENAME))
+
+
+class FeatureStore(object):
+    """
+    Read-only view over a packed feature store: fixed-shape entries stored in
+    large .npy shards, described by an index.json file.
+    Shards are memory-mapped, entries are returned as zero-copy tensors.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = Path(store_dir)
+        index = _read_index(self.store_dir)
+        self.shape = tuple(index["shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self.complete = index["complete"]
+        self.shard_files = [s["file"] for s in index["shards"]]
+        counts = [s["count"] for s in index["shards"]]
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self._shards = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def written(self) -> np.ndarray:
+        """
+        Mask of the entries which have been written: shards are preallocated, so entries left
+        unwritten by an interrupted run read as zeros.
+        """
+        fp = Path(self.store_dir, WRITTEN_FILENAME)
+        if not fp.is_file():
+            return np.full(len(self), self.complete, dtype=np.uint8)
+        return np.load(fp, mmap_mode="r")
+
+    def check_written(self, indices: Optional[Sequence[int]] = None):
+        """
+        Raises if any of the given entries (all entries by default) has not been written.
+        """
+        if indices is None:
+            if self.complete:
+                return
+            missing = int((self.written == 0).sum())
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+            missing = int((self.written[indices] == 0).sum())
+        if missing > 0:
+            raise ValueError(
+                f"{missing} entries of the feature store at {self.store_dir} have not been written, "
+                "resume the interrupted dino/extract_features.py or dino/pack_features.py run first"
+            )
+
+    def __getstate__(self):
+        # memory maps are not sent to DataLoader workers, each worker maps the shards itself
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    @property
+    def shards(self):
+        if self._shards is None:
+            # copy-on-write mapping: pages are shared with the page cache and the files are never modified
+            self._shards = [
+                np.load(Path(self.store_dir, f), mmap_mode="c")
+                for f in self.shard_files
+            ]
+        return self._shards
+
+    def locate(self, indices: np.ndarray):
+        shard_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        rows = indices - self.offsets[shard_ids]
+        return shard_ids, rows
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        if idx < 0:
+            idx += len(self)
+        shard_id, row = self.locate(np.int64(idx))
+        return torch.from_numpy(self.shards[shard_id][row])
+
+    def get_batch(self, indices: Sequence[int]) -> torch.Tensor:
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty((len(indices), *self.shape), dtype=self.dtype)
+        shard_ids, rows = self.locate(indices)
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            out[mask] = self.shards[shard_id][rows[mask]]
+        return torch.from_numpy(out)
+
+    def manifest(self) -> pd.DataFrame:
+        return pd.read_csv(Path(self.store_dir, MANIFEST_FILENAME))
+
+
+class FeatureStoreWriter(object):
+    """
+    Write fixed-shape entries into large preallocated .npy shards.
+    Writes are handed over to a background thread ; a written mask is kept on
+    disk so that an interrupted run can resume by skipping already written entries.
+    If the store already exists with the same layout, it is reopened (resume),
+    unless append=True, in which case `length` new entries are added after the existing ones.
+    """
+
+    def __init__(
+        self,
+        store_dir: str,
+        shape: Sequence[int],
+        length: int,
+        dtype: str = "float16",
+        shard_size: int = 4096,
+        append: bool = False,
+        max_queue_size: int = 16,
+    ):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.length = length
+        self.shard_size = shard_size
+        self.append = append
+
+        if is_feature_store(self.store_dir):
+            index = _read_index(self.store_dir)
+            if tuple(index["shape"]) != self.shape or index["dtype"] != self.dtype.name:
+                raise ValueError(
+                    f"existing store at {self.store_dir} has shape {index['shape']} and dtype {index['dtype']}, "
+                    f"got shape {list(self.shape)} and dtype {self.dtype.name}"
+                )
+            existing = sum(s["count"] for s in index["shards"])
+            if append:
+                self.start = existing
+                index["shards"].extend(self._allocate(len(index["shards"])))
+                index["complete"] = False
+                _write_index(self.store_dir, index)
+            elif existing == length:
+                self.start = 0
+            else:
+                raise ValueError(
+                    f"existing store at {self.store_dir} has {existing} entries, expected {length}"
+                )
+        else:
+            self.start = 0
+            index = {
+                "shape": list(self.shape),
+                "dtype": self.dtype.name,
+                "complete": False,
+                "shards": self._allocate(0),
+            }
+            _write_index(self.store_dir, index)
+        self.index = index
+        total = sum(s["count"] for s in index["shards"])
+        self.written = self._open_written_mask(total)
+
+        self.shard_files = [s["file"] for s in index["shards"]]
+        counts = [s["count"] for s in index["shards"]]
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.shards = [
+            np.load(Path(self.store_dir, f), mmap_mode="r+") for f in self.shard_files
+        ]
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _allocate(self, first_shard_id: int):
+        shards = []
+        for i, start in enumerate(range(0, self.length, self.shard_size)):
+            count = min(self.shard_size, self.length - start)
+            fname = f"shard_{first_shard_id+i:05}.npy"
+            shard = np.lib.format.open_memmap(
+                Path(self.store_dir, fname),
+                mode="w+",
+                dtype=self.dtype,
+                shape=(count, *self.shape),
+            )
+            del shard
+            shards.append({"file": fname, "count": count})
+        return shards
+
+    def _open_written_mask(self, total: int):
+        fp = Path(self.store_dir, WRITTEN_FILENAME)
+        previous = None
+        if fp.is_file():
+            previous = np.load(fp)
+            if len(previous) == total:
+                return np.load(fp, mmap_mode="r+")
+        written = np.lib.format.open_memmap(
+            fp, mode="w+", dtype=np.uint8, shape=(total,)
+        )
+        if previous is not None:
+            written[: len(previous)] = previous
+        return written
+
+    def pending(self) -> np.ndarray:
+        """
+        Indices (relative to this writer) which have not been written yet.
+        """
+        return np.flatnonzero(self.written[self.start : self.start + self.length] == 0)
+
+    def write(self, indices: Sequence[int], values):
+        """
+        Queue values for the given indices (relative to this writer).
+        """
+        if self._error is not None:
+            raise self._error
+        if isinstance(values, torch.Tensor):
+            values = values.detach().cpu().numpy()
+        indices = np.asarray(indices, dtype=np.int64) + self.start
+        self._queue.put((indices, values))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                indices, values = item
+                shard_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+                rows = indices - self.offsets[shard_ids]
+                for shard_id in np.unique(shard_ids):
+                    mask = shard_ids == shard_id
+                    self.shards[shard_id][rows[mask]] = values[mask]
+                self.written[indices] = 1
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+        for shard in self.shards:
+            shard.flush()
+        self.written.flush()
+
+    def close(self, names: Optional[Sequence[str]] = None, finalize: bool = True):
+        """
+        Wait for queued writes, then mark the store as complete if every entry has been written.
+        If given, names are appended to the store manifest (one per entry, in index order).
+        When several processes write to the same store, only one of them should finalize it.
+        """
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if not finalize:
+            return
+        if names is not None:
+            assert (
+                len(names) == self.length
+            ), f"expected {self.length} names, got {len(names)}"
+            manifest = pd.DataFrame(
+                {
+                    "index": np.arange(self.start, self.start + self.length),
+                    "name": list(names),
+                }
+            )
+            fp = Path(self.store_dir, MANIFEST_FILENAME)
+            if self.append and fp.is_file():
+                manifest.to_csv(fp, mode="a", header=False, index=False)
+            else:
+                manifest.to_csv(fp, index=False)
+        complete = bool(self.written.all())
+        if complete != self.index["complete"]:
+            self.index["complete"] = complete
+            _write_index(self.store_dir, self.index)
@@ -0,0 +1,48 @@
+import os
+
+from omegaconf import DictConfig
+from typing import Any, Dict, List, Optional
+
+
+class WorkerAffinity(object):
+    """
+    DataLoader worker_init_fn pinning each worker to its own cpu core (round robin over the cores
+    available to the process), so that workers of different ranks on a node do not share cores.
+    """
+
+    def __init__(self, num_workers: int, local_rank: int = 0):
+        self.num_workers = num_workers
+        self.local_rank = local_rank
+
+    def __call__(self, worker_id: int):
+        cores: List[int] = sorted(os.sched_getaffinity(0))
+        core = cores[(self.local_rank * self.num_workers + worker_id) % len(cores)]
+        os.sched_setaffinity(0, {core})
+
+
+def get_loader_kwargs(
+    loader_cfg: Optional[DictConfig], num_workers: int, local_rank: int = 0
+) -> Dict[str, Any]:
+    """
+    DataLoader keyword arguments from a speed.loader config block:
+    - pin_memory: copy batches to page-locked memory in a background thread of the main process
+    - persistent_workers: keep workers alive across epochs instead of forking them at every epoch
+    - prefetch_factor: number of batches loaded in advance by each worker (torch default is 2)
+    - cpu_affinity: pin each worker to its own cpu core (see WorkerAffinity)
+    - multiprocessing_context: start method of the workers ('fork', 'spawn' or 'forkserver'),
+      None for the platform default ; datasets sharing state with workers must use the same one
+    Options that only apply to worker processes are ignored when num_workers is 0.
+    """
+    kwargs = {"num_workers": num_workers, "pin_memory": True}
+    if loader_cfg is None:
+        return kwargs
+    kwargs["pin_memory"] = loader_cfg.pin_memory
+    if num_workers > 0:
+        kwargs["persistent_workers"] = loader_cfg.persistent_workers
+        if loader_cfg.prefetch_factor:
+            kwargs["prefetch_factor"] = loader_cfg.prefetch_factor
+        if loader_cfg.cpu_affinity and hasattr(os, "sched_setaffinity"):
+            kwargs["worker_init_fn"] = WorkerAffinity(num_workers, local_rank)
+        if loader_cfg.multiprocessing_context:
+            kwargs["multiprocessing_context"] = loader_cfg.multiprocessing_context
+    return kwargs
@@ -0,0 +1,220 @@
+import io
+import json
+import random
+import tarfile
+import warnings
+import torch
+import multiprocessing as mp
+
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from dino.data.decoders import pil_decoder
+from dino.distributed import get_rank, get_world_size
+
+
+SHARD_INDEX_FILENAME = "shards.json"
+
+
+def is_shard_dir(path) -> bool:
+    return Path(path, SHARD_INDEX_FILENAME).is_file()
+
+
+class ShardWriter(object):
+    """
+    Packs (encoded image, class index) samples into tar shards of shard_size samples each.
+    Each sample is stored as two consecutive members sharing the same key: {key}{ext} with the
+    encoded image bytes and {key}.cls with the class index. Shards are described by a shards.json
+    index file written on close().
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        classes: List[str],
+        shard_size: int = 5000,
+        prefix: str = "shard",
+    ):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.classes = classes
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.shards = []
+        self.nsamples = 0
+        self._tar = None
+
+    def _add(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def _next_shard(self):
+        self._close_shard()
+        fname = f"{self.prefix}_{len(self.shards):06}.tar"
+        self.shards.append({"file": fname, "count": 0})
+        self._tar = tarfile.open(Path(self.output_dir, fname), "w")
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def write(self, data: bytes, target: int, ext: str = ".jpg"):
+        if self._tar is None or self.shards[-1]["count"] == self.shard_size:
+            self._next_shard()
+        key = f"{self.nsamples:09}"
+        self._add(f"{key}{ext}", data)
+        self._add(f"{key}.cls", str(target).encode())
+        self.shards[-1]["count"] += 1
+        self.nsamples += 1
+
+    def close(self):
+        self._close_shard()
+        index = {"classes": self.classes, "shards": self.shards}
+        tmp_path = Path(self.output_dir, f"{SHARD_INDEX_FILENAME}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        tmp_path.replace(Path(self.output_dir, SHARD_INDEX_FILENAME))
+
+
+def iterate_shard(shard_path: str) -> Iterator[Tuple[bytes, int]]:
+    """
+    Reads a tar shard sequentially (streaming mode, no seek), yielding (encoded image, class index).
+    """
+    with tarfile.open(shard_path, "r|") as tar:
+        data, key = None, None
+        for member in tar:
+            if not member.isfile():
+                continue
+            stem, ext = member.name.rsplit(".", 1)
+            content = tar.extractfile(member).read()
+            if ext == "cls":
+                assert stem == key, f"{shard_path}: {member.name} has no image"
+                yield data, int(content)
+                data, key = None, None
+            else:
+                data, key = content, stem
+
+
+class TarShardDataset(torch.utils.data.IterableDataset):
+    """
+    Streams samples from tar shards written by ShardWriter (see dino/pack_images.py).
+    Each epoch, shards are shuffled with the same seed on every rank, then split across ranks and
+    DataLoader workers ; samples are further mixed with an in-memory shuffle buffer.
+    Every rank yields the same number of batches (some samples are repeated or dropped to even out
+    ranks), so call set_epoch() before each epoch as one would with DistributedSampler.
+    mp_context is the start method of the DataLoader workers (None for the platform default):
+    the epoch counter shared with workers has to be created from the same context.
+    """
+
+    def __init__(
+        self,
+        shard_dir: str,
+        transform: Optional[Callable] = None,
+        loader: Callable[[bytes], Any] = pil_decoder,
+        batch_size: int = 1,
+        shuffle_buffer: int = 10000,
+        seed: int = 0,
+        mp_context: Optional[str] = None,
+    ):
+        self.shard_dir = Path(shard_dir)
+        with open(Path(self.shard_dir, SHARD_INDEX_FILENAME), "r") as f:
+            index = json.load(f)
+        self.classes = index["classes"]
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.shard_files = [s["file"] for s in index["shards"]]
+        self.shard_counts = [s["count"] for s in index["shards"]]
+        self.transform = transform
+        self.loader = loader
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        # shared with DataLoader workers, so that set_epoch also reaches persistent workers
+        self._epoch = mp.get_context(mp_context).Value("i", 0)
+        self.nbatches = sum(self.shard_counts) // (self.world_size * batch_size)
+
+    def set_epoch(self, epoch: int):
+        self._epoch.value = epoch
+
+    @property
+    def nsamples(self):
+        return sum(self.shard_counts)
+
+    def __len__(self):
+        # number of samples per rank
+        return self.nbatches * self.batch_size
+
+    def worker_shards(self, epoch: int, worker_id: int, num_workers: int):
+        """
+        Returns the shards read by the given worker of this rank and the sample stride within
+        them, with the shard order of the given epoch.
+        """
+        shards = list(range(len(self.shard_files)))
+        random.Random(self.seed + epoch).shuffle(shards)
+        nreaders = self.world_size * num_workers
+        reader_id = self.rank * num_workers + worker_id
+        if len(shards) >= nreaders:
+            return shards[reader_id::nreaders], 1, 0
+        # fewer shards than readers: every reader goes through all shards, keeping one sample out of nreaders
+        warnings.warn(
+            f"{len(shards)} shards for {nreaders} readers, consider writing smaller shards"
+        )
+        return shards, nreaders, reader_id
+
+    def samples(self, shards: List[int], stride: int, offset: int, quota: int):
+        # cycles over the worker shards until its quota is reached
+        nyielded = 0
+        while nyielded < quota:
+            start = nyielded
+            for i in shards:
+                shard_path = Path(self.shard_dir, self.shard_files[i])
+                for j, sample in enumerate(iterate_shard(shard_path)):
+                    if j % stride != offset:
+                        continue
+                    yield sample
+                    nyielded += 1
+                    if nyielded == quota:
+                        return
+            if nyielded == start:
+                return
+
+    def __iter__(self):
+        epoch = self._epoch.value
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        # workers yield whole batches only, so that no rank ends the epoch earlier than the others
+        quota = (self.nbatches // num_workers) * self.batch_size
+        if worker_id < self.nbatches % num_workers:
+            quota += self.batch_size
+        shards, stride, offset = self.worker_shards(epoch, worker_id, num_workers)
+        if quota == 0 or len(shards) == 0:
+            return
+        rng = random.Random(
+            (self.seed + epoch) * self.world_size * num_workers
+            + self.rank * num_workers
+            + worker_id
+        )
+        buffer = []
+        for sample in self.samples(shards, stride, offset, quota):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            if buffer:
+                i = rng.randrange(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+            yield self.decode(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.decode(sample)
+
+    def decode(self, sample: Tuple[bytes, int]):
+        data, target = sample
+        img = self.loader(data)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, target
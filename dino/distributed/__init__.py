@@ -1,5 +1,15 @@
 import torch.distributed as dist
 
+from .device import (
+    get_device,
+    distributed_backend,
+    setup_cpu,
+    prepare_for_inference,
+    to_device,
+    inference_dtype,
+    inference_context,
+)
+
 
 def is_dist_avail_and_initialized():
     if not dist.is_available():
@@ -0,0 +1,91 @@
+import os
+import torch
+import torch.nn as nn
+
+from contextlib import contextmanager
+from typing import Optional
+
+
+def get_device(device: Optional[str] = None, gpu_id: int = -1) -> torch.device:
+    """
+    device is 'cuda' or 'cpu' ; if None, cuda is used when available.
+    On cuda, gpu_id (local rank) selects the gpu when >= 0.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda" and gpu_id >= 0:
+        return torch.device(f"cuda:{gpu_id}")
+    return torch.device(device)
+
+
+def distributed_backend(device: Optional[str] = None) -> Optional[str]:
+    """
+    Process group backend for the given device (see get_device), None to run in a single process:
+    nccl on cuda when several gpus are visible, gloo on cpu when several processes were launched
+    (e.g. with torchrun).
+    """
+    if get_device(device).type == "cuda":
+        return "nccl" if torch.cuda.device_count() > 1 else None
+    return "gloo" if int(os.environ.get("WORLD_SIZE", 1)) > 1 else None
+
+
+def setup_cpu(num_threads: Optional[int] = None):
+    """
+    Sets the number of intra-op threads to num_threads, or to the number of cores this process
+    may run on (which honors cgroup / SLURM cpu limits, unlike os.cpu_count()), split between
+    the processes launched on the node.
+    """
+    if not num_threads:
+        if hasattr(os, "sched_getaffinity"):
+            num_threads = len(os.sched_getaffinity(0))
+        else:
+            num_threads = os.cpu_count()
+        num_threads = max(1, num_threads // int(os.environ.get("LOCAL_WORLD_SIZE", 1)))
+    torch.set_num_threads(num_threads)
+    try:
+        # single batch at a time, inter-op parallelism only adds contention
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work
+        pass
+
+
+def prepare_for_inference(
+    model: nn.Module, device: torch.device, channels_last: bool = False
+) -> nn.Module:
+    model = model.to(device)
+    if channels_last and device.type == "cpu":
+        # faster convolutions (e.g. patch embedding) with oneDNN
+        model = model.to(memory_format=torch.channels_last)
+    return model.eval()
+
+
+def to_device(
+    x: torch.Tensor, device: torch.device, channels_last: bool = False
+) -> torch.Tensor:
+    x = x.to(device, non_blocking=device.type == "cuda")
+    if channels_last and device.type == "cpu" and x.dim() == 4:
+        x = x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def inference_dtype(device: torch.device, bf16: bool = False) -> torch.dtype:
+    """
+    Precision the model runs at under inference_context(device, bf16).
+    """
+    return torch.bfloat16 if bf16 and device.type == "cpu" else torch.float32
+
+
+@contextmanager
+def inference_context(device: torch.device, bf16: bool = False):
+    """
+    torch.inference_mode, plus bfloat16 autocast on cpu when bf16 is True.
+    Tensors created in this context cannot be used for autograd afterwards.
+    """
+    dtype = inference_dtype(device, bf16)
+    with torch.inference_mode(), torch.autocast(
+        device_type="cpu",
+        dtype=torch.bfloat16,
+        enabled=dtype == torch.bfloat16,
+    ):
+        yield
@@ -0,0 +1,103 @@
+import hashlib
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+from typing import Callable, Sequence
+
+from dino.data import FeatureStore, FeatureStoreWriter, is_feature_store
+
+
+def state_dict_hash(state_dict) -> str:
+    h = hashlib.sha1()
+    for k in sorted(state_dict):
+        h.update(k.encode())
+        h.update(state_dict[k].detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def feature_bank_version(
+    model: nn.Module, transform: Callable, dtype: torch.dtype = torch.float32
+) -> str:
+    """
+    Identifies features by the weights of the model that computed them, by the transform
+    applied to the tiles and by the precision the model ran at (e.g. bfloat16 autocast) ;
+    the same checkpoint evaluated twice (e.g. during tuning, then with eval_knn.py) maps to
+    the same version.
+    """
+    h = hashlib.sha1()
+    h.update(state_dict_hash(model.state_dict()).encode())
+    h.update(repr(transform).encode())
+    if dtype != torch.float32:
+        # float32 versions are unchanged, so that existing banks remain valid
+        h.update(str(dtype).encode())
+    return h.hexdigest()[:16]
+
+
+class FeatureBank(object):
+    """
+    On-disk bank of L2-normalized tile features, one packed feature store per version
+    (bank_dir/<version>) with entries keyed by tile path.
+    Features of tiles not yet in the bank are appended to the store, so that only new tiles
+    have to go through the model on later evaluations.
+    """
+
+    def __init__(self, bank_dir: str, version: str, shard_size: int = 65536):
+        self.store_dir = Path(bank_dir, version)
+        self.shard_size = shard_size
+        self._lookup = None
+
+    def __len__(self):
+        return len(self.lookup)
+
+    @property
+    def lookup(self) -> pd.Series:
+        # tile path -> store index
+        if self._lookup is None:
+            if is_feature_store(self.store_dir):
+                manifest = FeatureStore(self.store_dir).manifest()
+                self._lookup = pd.Series(
+                    manifest["index"].values, index=manifest["name"].values
+                )
+            else:
+                self._lookup = pd.Series([], dtype=np.int64)
+        return self._lookup
+
+    def indices(self, paths: Sequence[str]) -> np.ndarray:
+        """
+        Store index of each path, -1 for paths not in the bank.
+        """
+        indices = self.lookup.reindex(pd.Index(paths)).values
+        return np.nan_to_num(indices, nan=-1).astype(np.int64)
+
+    def missing(self, paths: Sequence[str]) -> np.ndarray:
+        """
+        Positions (in paths) of the tiles whose features are not in the bank.
+        """
+        return np.flatnonzero(self.indices(paths) < 0)
+
+    def add(self, paths: Sequence[str], features: torch.Tensor):
+        paths = pd.Index(paths)
+        keep = ~paths.isin(self.lookup.index) & ~paths.duplicated()
+        if not keep.any():
+            return
+        features = features[torch.from_numpy(keep).to(features.device)]
+        features = nn.functional.normalize(features.float(), dim=1)
+        writer = FeatureStoreWriter(
+            self.store_dir,
+            features.shape[1:],
+            int(keep.sum()),
+            dtype="float32",
+            shard_size=self.shard_size,
+            append=True,
+        )
+        writer.write(np.arange(len(features)), features)
+        writer.close(names=list(paths[keep]))
+        self._lookup = None
+
+    def get(self, paths: Sequence[str]) -> torch.Tensor:
+        indices = self.indices(paths)
+        assert (indices >= 0).all(), f"{(indices < 0).sum()} tiles are not in the bank"
+        return FeatureStore(self.store_dir).get_batch(indices)
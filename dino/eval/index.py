@@ -0,0 +1,338 @@
+import hashlib
+import torch
+
+from typing import Dict, Optional, Tuple
+
+
+INDEXES = ["exact", "ivf_flat", "ivf_pq"]
+
+
+def _topk_merge(
+    scores: torch.Tensor,
+    indices: torch.Tensor,
+    new_scores: torch.Tensor,
+    new_indices: torch.Tensor,
+    k: int,
+):
+    scores = torch.cat([scores, new_scores], dim=1)
+    indices = torch.cat([indices, new_indices], dim=1)
+    scores, pos = scores.topk(min(k, scores.shape[1]), dim=1, largest=True, sorted=True)
+    return scores, torch.gather(indices, 1, pos)
+
+
+def kmeans(
+    x: torch.Tensor,
+    n: int,
+    niter: int = 20,
+    spherical: bool = False,
+    max_points: Optional[int] = None,
+    chunk_size: int = 65536,
+    seed: int = 0,
+) -> torch.Tensor:
+    """
+    Lloyd's k-means, returns [n, d] centroids.
+    With spherical, points are assigned by inner product and centroids are L2-normalized
+    (suited to L2-normalized features compared by cosine similarity).
+    Centroids are trained on at most max_points randomly sampled points.
+    """
+    g = torch.Generator().manual_seed(seed)
+    if max_points is not None and x.shape[0] > max_points:
+        x = x[torch.randperm(x.shape[0], generator=g)[:max_points].to(x.device)]
+    n = min(n, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], generator=g)[:n].to(x.device)].clone()
+    for _ in range(niter):
+        assignments = assign(x, centroids, spherical, chunk_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=n).unsqueeze(1)
+        # empty clusters keep their previous centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+        if spherical:
+            centroids = torch.nn.functional.normalize(centroids, dim=1)
+    return centroids
+
+
+def assign(
+    x: torch.Tensor,
+    centroids: torch.Tensor,
+    spherical: bool = False,
+    chunk_size: int = 65536,
+) -> torch.Tensor:
+    assignments = []
+    for idx in range(0, x.shape[0], chunk_size):
+        chunk = x[idx : idx + chunk_size]
+        if spherical:
+            assignments.append(torch.mm(chunk, centroids.t()).argmax(dim=1))
+        else:
+            assignments.append(torch.cdist(chunk, centroids).argmin(dim=1))
+    return torch.cat(assignments)
+
+
+class ExactIndex(object):
+    """
+    Brute-force inner product search, queries are processed by chunks.
+    """
+
+    name = "exact"
+
+    def __init__(self, chunk_size: int = 1024):
+        self.chunk_size = chunk_size
+        self.features = None
+
+    def build(self, features: torch.Tensor):
+        self.features = features
+        return self
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def search(
+        self, queries: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        k = min(k, len(self))
+        scores, indices = [], []
+        for idx in range(0, queries.shape[0], self.chunk_size):
+            similarity = torch.mm(
+                queries[idx : idx + self.chunk_size], self.features.t()
+            )
+            s, i = similarity.topk(k, dim=1, largest=True, sorted=True)
+            scores.append(s)
+            indices.append(i)
+        return torch.cat(scores), torch.cat(indices)
+
+    def state_dict(self) -> Dict:
+        return {"chunk_size": self.chunk_size, "features": self.features}
+
+    def load_state_dict(self, state_dict: Dict):
+        self.chunk_size = state_dict["chunk_size"]
+        self.features = state_dict["features"]
+
+
+class IVFFlatIndex(object):
+    """
+    Inverted file index: features are partitioned in nlist clusters (spherical k-means) and
+    stored grouped by cluster ; a query is only compared to the features of its nprobe closest
+    clusters, which costs about nprobe / nlist of an exact search.
+    """
+
+    name = "ivf_flat"
+
+    def __init__(self, nlist: int = 1024, nprobe: int = 16, niter: int = 20):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.niter = niter
+        self.centroids = None
+        # features sorted by cluster: cluster i holds rows offsets[i]:offsets[i+1]
+        self.ids = None
+        self.offsets = None
+
+    def build(self, features: torch.Tensor):
+        self.centroids = kmeans(
+            features,
+            self.nlist,
+            self.niter,
+            spherical=True,
+            max_points=256 * self.nlist,
+        )
+        self.nlist = self.centroids.shape[0]
+        assignments = assign(features, self.centroids, spherical=True)
+        self.ids = torch.sort(assignments, stable=True)[1]
+        counts = torch.bincount(assignments, minlength=self.nlist)
+        self.offsets = torch.zeros(self.nlist + 1, dtype=torch.long)
+        self.offsets[1:] = torch.cumsum(counts, 0).cpu()
+        self.encode(features[self.ids], assignments[self.ids])
+        return self
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def encode(self, features: torch.Tensor, assignments: torch.Tensor):
+        self.features = features
+
+    def list_scores(self, queries: torch.Tensor, list_id: int) -> torch.Tensor:
+        start, end = self.offsets[list_id], self.offsets[list_id + 1]
+        return torch.mm(queries, self.features[start:end].t())
+
+    @torch.no_grad()
+    def search(
+        self, queries: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        nq = queries.shape[0]
+        k = min(k, len(self))
+        probes = torch.mm(queries, self.centroids.t()).topk(
+            min(self.nprobe, self.nlist), dim=1
+        )[1]
+        # go through clusters rather than queries: each cluster is scored against all the
+        # queries probing it with a single matrix product ; queries with less than k candidates
+        # get -inf scores (zero kNN weight) for the missing neighbors
+        top_scores = torch.full((nq, k), -float("inf"), device=queries.device)
+        top_indices = torch.full((nq, k), -1, dtype=torch.long, device=queries.device)
+        for list_id in torch.unique(probes).tolist():
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if start == end:
+                continue
+            rows = (probes == list_id).any(dim=1).nonzero().squeeze(1)
+            s = self.list_scores(queries[rows], list_id)
+            s, i = s.topk(min(k, int(end - start)), dim=1, largest=True, sorted=False)
+            i = self.ids[start:end][i]
+            top_scores[rows], top_indices[rows] = _topk_merge(
+                top_scores[rows], top_indices[rows], s, i, k
+            )
+        return top_scores, top_indices
+
+    def state_dict(self) -> Dict:
+        return {k: v for k, v in self.__dict__.items()}
+
+    def load_state_dict(self, state_dict: Dict):
+        self.__dict__.update(state_dict)
+
+
+class IVFPQIndex(IVFFlatIndex):
+    """
+    IVF index storing product-quantized residuals instead of raw features: each residual to its
+    cluster centroid is split in m sub-vectors, each encoded on 1 byte (256 centroids per
+    sub-space). Memory drops from 4 * d to m bytes per feature ; scores are approximate.
+    """
+
+    name = "ivf_pq"
+
+    def __init__(
+        self, nlist: int = 1024, nprobe: int = 16, m: int = 16, niter: int = 20
+    ):
+        super().__init__(nlist, nprobe, niter)
+        self.m = m
+        self.codebooks = None
+        self.codes = None
+
+    def encode(self, features: torch.Tensor, assignments: torch.Tensor):
+        n, d = features.shape
+        assert d % self.m == 0, f"feature dimension {d} is not divisible by m={self.m}"
+        residuals = (features - self.centroids[assignments]).view(n, self.m, -1)
+        self.codebooks = torch.stack(
+            [
+                kmeans(residuals[:, j], 256, self.niter, max_points=256 * 256)
+                for j in range(self.m)
+            ]
+        )
+        self.codes = torch.stack(
+            [assign(residuals[:, j], self.codebooks[j]) for j in range(self.m)], dim=1
+        ).to(torch.uint8)
+
+    def list_scores(self, queries: torch.Tensor, list_id: int) -> torch.Tensor:
+        start, end = self.offsets[list_id], self.offsets[list_id + 1]
+        # <q, c + r> = <q, c> + sum_j <q_j, codebook_j[code_j]>, from a [nq, m, 256] lookup table
+        lut = torch.einsum(
+            "qmd,mkd->qmk", queries.view(queries.shape[0], self.m, -1), self.codebooks
+        )
+        codes = self.codes[start:end].long()
+        s = torch.mv(queries, self.centroids[list_id]).unsqueeze(1)
+        for j in range(self.m):
+            s = s + lut[:, j, codes[:, j]]
+        return s
+
+
+class RerankIndex(object):
+    """
+    Wraps an approximate index: its top rerank * k candidates are re-scored exactly against the
+    raw features, so that returned scores (hence kNN weights) are exact inner products.
+    """
+
+    def __init__(
+        self, index, features: torch.Tensor, rerank: int = 4, chunk_size: int = 1024
+    ):
+        self.index = index
+        self.name = index.name
+        self.features = features
+        self.rerank = rerank
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.index)
+
+    def search(
+        self, queries: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        k = min(k, len(self))
+        _, candidates = self.index.search(queries, k * self.rerank)
+        scores, indices = [], []
+        for idx in range(0, queries.shape[0], self.chunk_size):
+            cand = candidates[idx : idx + self.chunk_size]
+            s = torch.einsum(
+                "qd,qkd->qk",
+                queries[idx : idx + self.chunk_size],
+                self.features[cand.clamp(min=0)],
+            )
+            # missing candidates (-1) keep a -inf score
+            s = s.masked_fill(cand < 0, -float("inf"))
+            s, pos = s.topk(min(k, s.shape[1]), dim=1, largest=True, sorted=True)
+            scores.append(s)
+            indices.append(torch.gather(cand, 1, pos))
+        return torch.cat(scores), torch.cat(indices)
+
+
+def features_fingerprint(features: torch.Tensor) -> str:
+    """
+    Identifies the features an index is built on (count, dimension and values).
+    """
+    h = hashlib.sha1(str(tuple(features.shape)).encode())
+    h.update(features.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def build_index(name: str, features: torch.Tensor, **kwargs):
+    """
+    - exact: brute-force search
+    - ivf_flat: inverted file index (kwargs: nlist, nprobe)
+    - ivf_pq: inverted file index with product-quantized features (kwargs: nlist, nprobe, m)
+    """
+    if name == "exact":
+        index = ExactIndex()
+    elif name == "ivf_flat":
+        index = IVFFlatIndex(kwargs["nlist"], kwargs["nprobe"])
+    elif name == "ivf_pq":
+        index = IVFPQIndex(kwargs["nlist"], kwargs["nprobe"], kwargs["m"])
+    else:
+        raise ValueError(f"unknown index {name}, should be one of {INDEXES}")
+    return index.build(features)
+
+
+def save_index(index, path: str, fingerprint: Optional[str] = None):
+    """
+    fingerprint identifies the features the index was built on (see features_fingerprint).
+    """
+    torch.save(
+        {
+            "name": index.name,
+            "fingerprint": fingerprint,
+            "state_dict": index.state_dict(),
+        },
+        path,
+    )
+
+
+def load_index(
+    path: str,
+    device: Optional[torch.device] = None,
+    fingerprint: Optional[str] = None,
+):
+    """
+    Returns None if fingerprint is given and differs from the one the index was saved with,
+    i.e. if the index was built on other features (another checkpoint or query set).
+    """
+    checkpoint = torch.load(path, map_location=device)
+    if fingerprint is not None and checkpoint.get("fingerprint") != fingerprint:
+        return None
+    index = {"exact": ExactIndex, "ivf_flat": IVFFlatIndex, "ivf_pq": IVFPQIndex}[
+        checkpoint["name"]
+    ]()
+    index.load_state_dict(checkpoint["state_dict"])
+    return index
+
+
+def recall_at_k(index, exact_index: ExactIndex, queries: torch.Tensor, k: int) -> float:
+    """
+    Fraction of the exact k nearest neighbors that the index retrieves in its top k.
+    """
+    _, approx = index.search(queries, k)
+    _, exact = exact_index.search(queries, k)
+    found = (approx.unsqueeze(2) == exact.unsqueeze(1)).any(dim=1)
+    return found.float().mean().item()
@@ -2,8 +2,12 @@ import os
 import sys
 import tqdm
 import hydra
+import atexit
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
+import multiprocessing as mp
 
 import torch
 import torch.nn as nn
@@ -11,13 +15,21 @@ import torch.distributed as dist
 import torch.backends.cudnn as cudnn
 
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Dict, Optional, Tuple
 from sklearn import metrics
 from omegaconf import DictConfig
 from torchvision import transforms
 
 import dino.models.vision_transformer as vits
 from dino.data import ImagePretrainingDataset
+from dino.distributed import (
+    get_device,
+    distributed_backend,
+    setup_cpu,
+    prepare_for_inference,
+    to_device,
+    inference_context,
+)
 
 
 def is_dist_avail_and_initialized():
@@ -44,6 +56,139 @@ class ReturnIndexDataset(ImagePretrainingDataset):
         return idx, img, label
 
 
+class TileCache(object):
+    """
+    Cache of transformed uint8 tiles in a memory-mapped array of max_tiles slots, shared by
+    DataLoader workers and kept across loader iterations ; once full, the least recently used
+    tile is evicted. Files live in a temporary directory under cache_dir (by default /dev/shm
+    when available, i.e. in RAM), removed when the process exits.
+    mp_context is the start method of the DataLoader workers (None for the platform default):
+    the lock and clock shared with workers have to be created from the same context.
+    """
+
+    def __init__(
+        self,
+        ntiles: int,
+        tile_shape: Tuple[int, ...],
+        max_tiles: int,
+        cache_dir: Optional[str] = None,
+        mp_context: Optional[str] = None,
+    ):
+        if cache_dir is None and Path("/dev/shm").is_dir():
+            cache_dir = "/dev/shm"
+        self.cache_dir = Path(tempfile.mkdtemp(prefix="tile_cache_", dir=cache_dir))
+        atexit.register(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self.max_tiles = min(max_tiles, ntiles)
+        # tile index -> slot, slot -> tile index, slot -> last access time
+        arrays = {
+            "tiles": ((self.max_tiles, *tile_shape), np.uint8, 0),
+            "slots": ((ntiles,), np.int64, -1),
+            "owners": ((self.max_tiles,), np.int64, -1),
+            "last_used": ((self.max_tiles,), np.int64, -1),
+        }
+        for name, (shape, dtype, fill) in arrays.items():
+            a = np.lib.format.open_memmap(
+                Path(self.cache_dir, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape
+            )
+            a[:] = fill
+            a.flush()
+        ctx = mp.get_context(mp_context)
+        self.lock = ctx.Lock()
+        self.clock = ctx.Value("q", 0, lock=False)
+        self._arrays = None
+
+    def __getstate__(self):
+        # memory maps are not sent to DataLoader workers, each worker maps the files itself
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {
+                f.stem: np.load(f, mmap_mode="r+") for f in self.cache_dir.glob("*.npy")
+            }
+        return self._arrays
+
+    def tick(self, slot: int):
+        self.clock.value += 1
+        self.arrays["last_used"][slot] = self.clock.value
+
+    def get(self, idx: int) -> Optional[np.ndarray]:
+        with self.lock:
+            slot = self.arrays["slots"][idx]
+            if slot < 0:
+                return None
+            self.tick(slot)
+            return np.array(self.arrays["tiles"][slot])
+
+    def put(self, idx: int, tile: np.ndarray):
+        a = self.arrays
+        with self.lock:
+            if a["slots"][idx] >= 0:
+                return
+            # free slots have last_used = -1, so they are picked before evicting anything
+            slot = int(np.argmin(a["last_used"]))
+            if a["owners"][slot] >= 0:
+                a["slots"][a["owners"][slot]] = -1
+            a["tiles"][slot] = tile
+            a["owners"][slot] = idx
+            a["slots"][idx] = slot
+            self.tick(slot)
+
+
+class CachedReturnIndexDataset(ReturnIndexDataset):
+    """
+    Applies cache_transform (deterministic, returning uint8 tensors) once per tile and keeps
+    its output in a TileCache ; transform is then applied to the cached tensor at each access.
+    """
+
+    def __init__(
+        self,
+        tiles_df: pd.DataFrame,
+        cache_transform: Callable,
+        transform: Optional[Callable],
+        tile_shape: Tuple[int, ...],
+        max_tiles: int,
+        cache_dir: Optional[str] = None,
+        label_name: Optional[str] = None,
+        mp_context: Optional[str] = None,
+    ):
+        super().__init__(tiles_df, transform=transform, label_name=label_name)
+        self.cache_transform = cache_transform
+        self.cache = TileCache(len(self), tile_shape, max_tiles, cache_dir, mp_context)
+
+    def __getitem__(self, idx):
+        tile = self.cache.get(idx)
+        if tile is None:
+            tile = self.cache_transform(self.loader(self.tile_paths[idx]))
+            self.cache.put(idx, tile.numpy())
+        else:
+            tile = torch.from_numpy(tile)
+        if self.transform is not None:
+            tile = self.transform(tile)
+        label = -1
+        if self.labels is not None:
+            label = self.labels[idx]
+        return idx, tile, label
+
+
+def make_knn_transform():
+    """
+    Transform applied to tuning & evaluation tiles (see prepare_data), also used to version
+    feature banks.
+    """
+    return transforms.Compose(
+        [
+            transforms.Resize(256, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.CenterCrop(224),
+            transforms.ToTensor(),
+            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+        ]
+    )
+
+
 def prepare_data(
     query_df: pd.DataFrame,
     test_df: pd.DataFrame,
@@ -51,22 +196,49 @@ def prepare_data(
     distributed,
     num_workers,
     label_name: Optional[str] = None,
+    tile_cache_size: Optional[int] = None,
+    tile_cache_dir: Optional[str] = None,
+    loader_kwargs: Optional[Dict[str, Any]] = None,
 ):
     # ============ preparing data ... ============
-    transform = transforms.Compose(
-        [
-            transforms.Resize(256, interpolation=transforms.InterpolationMode.BICUBIC),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    # resize & crop are deterministic: with tile_cache_size, their output is cached as uint8 tensors
+    resize_crop = [
+        transforms.Resize(256, interpolation=transforms.InterpolationMode.BICUBIC),
+        transforms.CenterCrop(224),
+    ]
+    normalize = transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
+    # loader_kwargs (see dino.data.get_loader_kwargs) override num_workers & pin_memory
+    loader_kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": True,
+        **(loader_kwargs or {}),
+    }
+    if tile_cache_size:
+        cache_transform = transforms.Compose(resize_crop + [transforms.PILToTensor()])
+        transform = transforms.Compose(
+            [transforms.ConvertImageDtype(torch.float), normalize]
+        )
+        query_dataset, test_dataset = [
+            CachedReturnIndexDataset(
+                df,
+                cache_transform,
+                transform,
+                (3, 224, 224),
+                tile_cache_size,
+                cache_dir=tile_cache_dir,
+                label_name=label_name,
+                mp_context=loader_kwargs.get("multiprocessing_context"),
+            )
+            for df in [query_df, test_df]
         ]
-    )
-    query_dataset = ReturnIndexDataset(
-        query_df, transform=transform, label_name=label_name
-    )
-    test_dataset = ReturnIndexDataset(
-        test_df, transform=transform, label_name=label_name
-    )
+    else:
+        transform = make_knn_transform()
+        query_dataset = ReturnIndexDataset(
+            query_df, transform=transform, label_name=label_name
+        )
+        test_dataset = ReturnIndexDataset(
+            test_df, transform=transform, label_name=label_name
+        )
     if distributed:
         sampler = torch.utils.data.DistributedSampler(query_dataset, shuffle=False)
     else:
@@ -75,16 +247,14 @@ def prepare_data(
         query_dataset,
         sampler=sampler,
         batch_size=batch_size_per_gpu,
-        num_workers=num_workers,
-        pin_memory=True,
         drop_last=False,
+        **loader_kwargs,
     )
     test_data_loader = torch.utils.data.DataLoader(
         test_dataset,
         batch_size=batch_size_per_gpu,
-        num_workers=num_workers,
-        pin_memory=True,
         drop_last=False,
+        **loader_kwargs,
     )
     return query_data_loader, test_data_loader
 
@@ -143,6 +313,9 @@ def extract_feature_pipeline(
     use_cuda: bool = True,
     num_workers: int = 10,
     label_name: Optional[str] = None,
+    device: Optional[torch.device] = None,
+    bf16: bool = False,
+    channels_last: bool = False,
 ):
     # ============ preparing data ... ============
     query_data_loader, test_data_loader = prepare_data(
@@ -160,19 +333,32 @@ def extract_feature_pipeline(
     # ============ building network ... ============
     model = vits.__dict__[arch](img_size=input_size, patch_size=patch_size, num_classes=0)
     print(f"Model {arch} {patch_size}x{patch_size} built.")
-    model.cuda()
+    if device is None:
+        device = get_device()
     print("Loading pretrained weights...")
     load_pretrained_weights(model, pretrained_weights, checkpoint_key)
-    model.eval()
+    model = prepare_for_inference(model, device, channels_last)
 
     # ============ extract features ... ============
     print("Extracting features for query set...")
     query_features, query_labels = extract_features(
-        model, query_data_loader, distributed, use_cuda
+        model,
+        query_data_loader,
+        distributed,
+        use_cuda,
+        device=device,
+        bf16=bf16,
+        channels_last=channels_last,
     )
     print("Extracting features for test set...")
     test_features, test_labels = extract_features(
-        model, test_data_loader, distributed, use_cuda
+        model,
+        test_data_loader,
+        distributed,
+        use_cuda,
+        device=device,
+        bf16=bf16,
+        channels_last=channels_last,
     )
 
     if is_main_process():
@@ -196,13 +382,20 @@ def extract_multiple_features(
     distributed,
     use_cuda=True,
     multiscale=False,
+    device: Optional[torch.device] = None,
+    bf16: bool = False,
+    channels_last: bool = False,
 ):
+    # see extract_features for device, bf16 & channels_last
+    if device is None:
+        device = get_device()
+    use_cuda = use_cuda and device.type == "cuda"
     student_features = None
     teacher_features = None
 
     labels = []
 
-    with tqdm.tqdm(
+    with inference_context(device, bf16), tqdm.tqdm(
         loader,
         desc=("Feature extraction"),
         unit=" slide",
@@ -213,8 +406,8 @@ def extract_multiple_features(
     ) as t:
         for i, batch in enumerate(t):
             index, img, label = batch
-            index = index.cuda(non_blocking=True)
-            img = img.cuda(non_blocking=True)
+            index = index.to(device, non_blocking=True)
+            img = to_device(img, device, channels_last)
             labels.extend(label.clone().tolist())
             if multiscale:
                 student_feats = multi_scale(img, student)
@@ -311,11 +504,27 @@ def extract_multiple_features(
 
 
 @torch.no_grad()
-def extract_features(model, loader, distributed, use_cuda=True, multiscale=False):
+def extract_features(
+    model,
+    loader,
+    distributed,
+    use_cuda=True,
+    multiscale=False,
+    device: Optional[torch.device] = None,
+    bf16: bool = False,
+    channels_last: bool = False,
+):
+    """
+    Runs on device (cuda when available if None) ; use_cuda keeps the feature matrix on gpu.
+    On cpu, bf16 enables bfloat16 autocast and channels_last converts images to channels last.
+    """
+    if device is None:
+        device = get_device()
+    use_cuda = use_cuda and device.type == "cuda"
     features = None
     labels = []
 
-    with tqdm.tqdm(
+    with inference_context(device, bf16), tqdm.tqdm(
         loader,
         desc=("Feature extraction"),
         unit=" slide",
@@ -325,8 +534,8 @@ def extract_features(model, loader, distributed, use_cuda=True, multiscale=False
     ) as t:
         for i, batch in enumerate(t):
             index, img, label = batch
-            img = img.cuda(non_blocking=True)
-            index = index.cuda(non_blocking=True)
+            img = to_device(img, device, channels_last)
+            index = index.to(device, non_blocking=True)
             labels.extend(label.clone().tolist())
             if multiscale:
                 feats = multi_scale(img, model)
@@ -383,55 +592,100 @@ def extract_features(model, loader, distributed, use_cuda=True, multiscale=False
     return features, labels
 
 
+def knn_chunk_size(
+    num_query: int, element_size: int = 4, memory_budget: int = 1024
+) -> int:
+    """
+    Number of test features per chunk so that the [chunk, num_query] similarity matrix
+    fits in memory_budget MB.
+    """
+    return max(1, (memory_budget * 1024**2) // (num_query * element_size))
+
+
 @torch.no_grad()
-def knn_classifier(
-    query_features, query_labels, test_features, test_labels, k, T, num_classes
+def knn_classifier_multi_k(
+    query_features,
+    query_labels,
+    test_features,
+    test_labels,
+    ks,
+    T,
+    num_classes,
+    memory_budget: int = 1024,
+    index=None,
 ):
-    acc, total = 0.0, 0
-    test_probs = np.empty((0, num_classes))
+    """
+    Weighted kNN classification for several values of k in a single pass over the test features:
+    test features are processed by chunks sized from memory_budget (MB), the top max(ks) neighbors
+    of each chunk are retrieved once and sliced for smaller k.
+    If index is given (see dino.eval.index, built on query_features), neighbors are searched
+    with it instead of the brute-force similarity matrix.
+    Returns {k: (acc, auc)}.
+    """
+    num_test_images = test_labels.shape[0]
+    ks = sorted(set(ks))
+    max_k = min(ks[-1], query_labels.shape[0])
     query_features = query_features.t()
-    num_test_images, num_chunks = test_labels.shape[0], min(test_labels.shape[0], 100)
-    imgs_per_chunk = num_test_images // num_chunks
-    retrieval_one_hot = torch.zeros(k, num_classes).to(query_features.device)
-    for idx in range(0, num_test_images, imgs_per_chunk):
-        # get the features for test images
-        # the use of min ensures we don't compute features more than once if num_test_images is not divisible by num_chunks
-        features = test_features[idx : min((idx + imgs_per_chunk), num_test_images), :]
-        targets = test_labels[idx : min((idx + imgs_per_chunk), num_test_images)]
-        batch_size = targets.shape[0]
+    chunk_size = knn_chunk_size(
+        query_labels.shape[0], query_features.element_size(), memory_budget
+    )
+    device = query_features.device
+    test_probs = {
+        k: torch.empty(num_test_images, num_classes, device=device) for k in ks
+    }
+    for idx in range(0, num_test_images, chunk_size):
+        features = test_features[idx : idx + chunk_size, :]
 
         # calculate the dot product and compute top-k neighbors
-        similarity = torch.mm(features, query_features)
-        distances, indices = similarity.topk(k, largest=True, sorted=True)
-        candidates = query_labels.view(1, -1).expand(batch_size, -1)
-        retrieved_neighbors = torch.gather(candidates, 1, indices)
-
-        retrieval_one_hot.resize_(batch_size * k, num_classes).zero_()
-        retrieval_one_hot.scatter_(1, retrieved_neighbors.view(-1, 1), 1)
-        distances_transform = distances.clone().div_(T).exp_()
-        probs = torch.sum(
-            torch.mul(
-                retrieval_one_hot.view(batch_size, -1, num_classes),
-                distances_transform.view(batch_size, -1, 1),
-            ),
-            1,
-        )
-        _, predictions = probs.sort(1, True)
-        p = (probs / probs.sum(dim=-1).unsqueeze(-1)).cpu().detach().numpy()
-        test_probs = np.append(test_probs, p, axis=0)
-
-        # find the predictions that match the target
-        correct = predictions.eq(targets.data.view(-1, 1))
-        acc = acc + correct.narrow(1, 0, 1).sum().item()
-        total += targets.size(0)
-
-    acc = acc * 100.0 / total
-    if num_classes == 2:
-        auc = metrics.roc_auc_score(test_labels.cpu(), test_probs[:, 1])
-    else:
-        auc = metrics.roc_auc_score(test_labels.cpu(), test_probs, multi_class="ovr")
+        if index is not None:
+            distances, indices = index.search(features, max_k)
+        else:
+            similarity = torch.mm(features, query_features)
+            distances, indices = similarity.topk(max_k, largest=True, sorted=True)
+            del similarity
+        retrieved_neighbors = query_labels[indices]
+        weights = distances.div_(T).exp_()
+
+        for k in ks:
+            probs = test_probs[k][idx : idx + chunk_size]
+            probs.zero_().scatter_add_(1, retrieved_neighbors[:, :k], weights[:, :k])
+            probs.div_(probs.sum(dim=-1, keepdim=True))
+
+    results = {}
+    test_labels = test_labels.cpu()
+    for k in ks:
+        probs = test_probs[k].cpu()
+        acc = probs.argmax(dim=1).eq(test_labels).sum().item() * 100.0 / num_test_images
+        if num_classes == 2:
+            auc = metrics.roc_auc_score(test_labels, probs[:, 1].numpy())
+        else:
+            auc = metrics.roc_auc_score(test_labels, probs.numpy(), multi_class="ovr")
+        results[k] = (acc, auc)
+    return results
 
-    return acc, auc
+
+def knn_classifier(
+    query_features,
+    query_labels,
+    test_features,
+    test_labels,
+    k,
+    T,
+    num_classes,
+    memory_budget: int = 1024,
+    index=None,
+):
+    return knn_classifier_multi_k(
+        query_features,
+        query_labels,
+        test_features,
+        test_labels,
+        [k],
+        T,
+        num_classes,
+        memory_budget,
+        index,
+    )[k]
 
 
 @hydra.main(
@@ -440,9 +694,11 @@ def knn_classifier(
     config_name="knn",
 )
 def main(cfg: DictConfig):
-    distributed = torch.cuda.device_count() > 1
+    # nccl across gpus, or gloo when running several processes on cpu
+    backend = distributed_backend(cfg.speed.device)
+    distributed = backend is not None
     if distributed:
-        torch.distributed.init_process_group(backend="nccl")
+        torch.distributed.init_process_group(backend=backend)
         gpu_id = int(os.environ["LOCAL_RANK"])
         if gpu_id == 0:
             print("Distributed session successfully initialized")
@@ -452,6 +708,9 @@ def main(cfg: DictConfig):
         print(f"torch.cuda.device_count(): {torch.cuda.device_count()}")
 
     cudnn.benchmark = True
+    device = get_device(cfg.speed.device, gpu_id)
+    if device.type == "cpu":
+        setup_cpu(cfg.speed.num_threads)
 
     if cfg.load_features:
         query_features = torch.load(Path(cfg.features_dir, "query_feat.pt"))
@@ -482,6 +741,9 @@ def main(cfg: DictConfig):
             use_cuda=cfg.speed.use_cuda,
             num_workers=cfg.speed.num_workers,
             label_name=cfg.label_name,
+            device=device,
+            bf16=cfg.speed.bf16,
+            channels_last=cfg.speed.channels_last,
         )
 
     if is_main_process():
@@ -489,21 +751,24 @@ def main(cfg: DictConfig):
             torch.unique(test_labels)
         ), "query & test dataset have different number of classes!"
         num_classes = len(torch.unique(query_labels))
-        if cfg.speed.use_cuda:
+        if cfg.speed.use_cuda and device.type == "cuda":
             query_features, query_labels = query_features.cuda(), query_labels.cuda()
             test_features, test_labels = test_features.cuda(), test_labels.cuda()
 
         print("Features are ready!\nStarting kNN classification.")
+        # a single similarity pass serves all values of k
+        knn_results = knn_classifier_multi_k(
+            query_features,
+            query_labels,
+            test_features,
+            test_labels,
+            cfg.nb_knn,
+            cfg.temperature,
+            num_classes,
+            memory_budget=cfg.speed.memory_budget,
+        )
         for k in cfg.nb_knn:
-            acc, auc = knn_classifier(
-                query_features,
-                query_labels,
-                test_features,
-                test_labels,
-                k,
-                cfg.temperature,
-                num_classes,
-            )
+            acc, auc = knn_results[k]
             print(f"{k}-NN classifier result:")
             print(f"- auc: {auc}")
             print(f"- accuracy: {acc:.2f}%")
@@ -1,4 +1,5 @@
 import os
+import time
 import tqdm
 import hydra
 import datetime
@@ -12,14 +13,35 @@ import torch.backends.cudnn as cudnn
 
 from pathlib import Path
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 from sklearn import metrics
 from omegaconf import DictConfig
 from torchvision import transforms
 
 import dino.models.vision_transformer as vits
-from dino.data import ImagePretrainingDataset
+from dino.data import ImagePretrainingDataset, FeatureStore, is_feature_store
 from dino.log import initialize_wandb
-from dino.distributed import is_main_process
+from dino.distributed import (
+    is_main_process,
+    get_device,
+    distributed_backend,
+    setup_cpu,
+    prepare_for_inference,
+    to_device,
+    inference_dtype,
+    inference_context,
+)
+from dino.eval.knn import knn_classifier_multi_k, make_knn_transform
+from dino.eval.feature_bank import FeatureBank, feature_bank_version
+from dino.eval.index import (
+    ExactIndex,
+    RerankIndex,
+    build_index,
+    features_fingerprint,
+    save_index,
+    load_index,
+    recall_at_k,
+)
 
 
 class ReturnIndexDataset(ImagePretrainingDataset):
@@ -37,14 +59,7 @@ def prepare_data(
     label_name: Optional[str] = None,
 ):
     # ============ preparing data ... ============
-    transform = transforms.Compose(
-        [
-            transforms.Resize(256, interpolation=transforms.InterpolationMode.BICUBIC),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-        ]
-    )
+    transform = make_knn_transform()
     query_dataset = ReturnIndexDataset(
         query_df, transform=transform, label_name=label_name
     )
@@ -127,7 +142,31 @@ def extract_feature_pipeline(
     use_cuda: bool = True,
     num_workers: int = 10,
     label_name: Optional[str] = None,
+    device: Optional[torch.device] = None,
+    bf16: bool = False,
+    channels_last: bool = False,
+    feature_bank_dir: Optional[str] = None,
 ):
+    if feature_bank_dir is not None:
+        return extract_feature_pipeline_with_bank(
+            query_df,
+            test_df,
+            feature_bank_dir,
+            arch,
+            input_size,
+            patch_size,
+            pretrained_weights,
+            checkpoint_key,
+            batch_size_per_gpu,
+            distributed,
+            use_cuda,
+            num_workers,
+            label_name,
+            device,
+            bf16,
+            channels_last,
+        )
+
     # ============ preparing data ... ============
     query_data_loader, test_data_loader = prepare_data(
         query_df,
@@ -142,21 +181,36 @@ def extract_feature_pipeline(
     )
 
     # ============ building network ... ============
-    model = vits.__dict__[arch](img_size=input_size, patch_size=patch_size, num_classes=0)
+    model = vits.__dict__[arch](
+        img_size=input_size, patch_size=patch_size, num_classes=0
+    )
     print(f"Model {arch} {patch_size}x{patch_size} built.")
-    model.cuda()
+    if device is None:
+        device = get_device()
     print("Loading pretrained weights...")
     load_pretrained_weights(model, pretrained_weights, checkpoint_key)
-    model.eval()
+    model = prepare_for_inference(model, device, channels_last)
 
     # ============ extract features ... ============
     print("Extracting features for query set...")
     query_features, query_labels = extract_features(
-        model, query_data_loader, distributed, use_cuda
+        model,
+        query_data_loader,
+        distributed,
+        use_cuda,
+        device=device,
+        bf16=bf16,
+        channels_last=channels_last,
     )
     print("Extracting features for test set...")
     test_features, test_labels = extract_features(
-        model, test_data_loader, distributed, use_cuda
+        model,
+        test_data_loader,
+        distributed,
+        use_cuda,
+        device=device,
+        bf16=bf16,
+        channels_last=channels_last,
     )
 
     if is_main_process():
@@ -172,12 +226,106 @@ def extract_feature_pipeline(
     return query_features, test_features, query_labels, test_labels
 
 
+def extract_feature_pipeline_with_bank(
+    query_df: pd.DataFrame,
+    test_df: pd.DataFrame,
+    feature_bank_dir: str,
+    arch: str,
+    input_size: int,
+    patch_size: int,
+    pretrained_weights: str,
+    checkpoint_key: str,
+    batch_size_per_gpu: int,
+    distributed: bool,
+    use_cuda: bool = True,
+    num_workers: int = 10,
+    label_name: Optional[str] = None,
+    device: Optional[torch.device] = None,
+    bf16: bool = False,
+    channels_last: bool = False,
+):
+    """
+    Same as extract_feature_pipeline, but features are read from (and added to) a feature bank:
+    only tiles whose features are not in the bank yet go through the model.
+    """
+    model = vits.__dict__[arch](
+        img_size=input_size, patch_size=patch_size, num_classes=0
+    )
+    load_pretrained_weights(model, pretrained_weights, checkpoint_key)
+    if device is None:
+        device = get_device()
+    bank = FeatureBank(
+        feature_bank_dir,
+        feature_bank_version(
+            model, make_knn_transform(), inference_dtype(device, bf16)
+        ),
+    )
+    print(f"Feature bank at {bank.store_dir} ({len(bank)} tiles)")
+
+    query_missing = query_df.iloc[bank.missing(query_df.tile_path.values)]
+    test_missing = test_df.iloc[bank.missing(test_df.tile_path.values)]
+    if len(query_missing) + len(test_missing) > 0:
+        print(
+            f"Extracting features for {len(query_missing)} query and {len(test_missing)} test tiles not in the bank..."
+        )
+        query_data_loader, test_data_loader = prepare_data(
+            query_missing.reset_index(drop=True),
+            test_missing.reset_index(drop=True),
+            batch_size_per_gpu,
+            distributed,
+            num_workers,
+            label_name,
+        )
+        model = prepare_for_inference(model, device, channels_last)
+        for df, loader in [
+            (query_missing, query_data_loader),
+            (test_missing, test_data_loader),
+        ]:
+            if len(df) == 0:
+                continue
+            features, _ = extract_features(
+                model,
+                loader,
+                distributed,
+                use_cuda,
+                device=device,
+                bf16=bf16,
+                channels_last=channels_last,
+            )
+            if is_main_process():
+                bank.add(df.tile_path.values, features)
+        if distributed:
+            torch.distributed.barrier()
+
+    query_features = bank.get(query_df.tile_path.values)
+    test_features = bank.get(test_df.tile_path.values)
+    query_labels = torch.tensor(query_df[label_name].values).long()
+    test_labels = torch.tensor(test_df[label_name].values).long()
+    return query_features, test_features, query_labels, test_labels
+
+
 @torch.no_grad()
-def extract_features(model, loader, distributed, use_cuda=True, multiscale=False):
+def extract_features(
+    model,
+    loader,
+    distributed,
+    use_cuda=True,
+    multiscale=False,
+    device: Optional[torch.device] = None,
+    bf16: bool = False,
+    channels_last: bool = False,
+):
+    """
+    Runs on device (cuda when available if None) ; use_cuda keeps the feature matrix on gpu.
+    On cpu, bf16 enables bfloat16 autocast and channels_last converts images to channels last.
+    """
+    if device is None:
+        device = get_device()
+    use_cuda = use_cuda and device.type == "cuda"
     features = None
     labels = []
 
-    with tqdm.tqdm(
+    with inference_context(device, bf16), tqdm.tqdm(
         loader,
         desc=("Feature extraction"),
         unit=" slide",
@@ -187,8 +335,8 @@ def extract_features(model, loader, distributed, use_cuda=True, multiscale=False
     ) as t:
         for i, batch in enumerate(t):
             index, img, label = batch
-            img = img.cuda(non_blocking=True)
-            index = index.cuda(non_blocking=True)
+            img = to_device(img, device, channels_last)
+            index = index.to(device, non_blocking=True)
             labels.extend(label.clone().tolist())
             if multiscale:
                 feats = multi_scale(img, model)
@@ -245,80 +393,66 @@ def extract_features(model, loader, distributed, use_cuda=True, multiscale=False
     return features, labels
 
 
-@torch.no_grad()
-def knn_classifier(
-    query_features, query_labels, test_features, test_labels, k, T, num_classes
-):
-    acc, total = 0.0, 0
-    test_probs = np.empty((0, num_classes))
-    query_features = query_features.t()
-    num_test_images, num_chunks = test_labels.shape[0], min(test_labels.shape[0], 100)
-    imgs_per_chunk = num_test_images // num_chunks
-    retrieval_one_hot = torch.zeros(k, num_classes).to(query_features.device)
-    for idx in range(0, num_test_images, imgs_per_chunk):
-        # get the features for test images
-        # the use of min ensures we don't compute features more than once if num_test_images is not divisible by num_chunks
-        features = test_features[idx : min((idx + imgs_per_chunk), num_test_images), :]
-        targets = test_labels[idx : min((idx + imgs_per_chunk), num_test_images)]
-        batch_size = targets.shape[0]
-
-        # calculate the dot product and compute top-k neighbors
-        similarity = torch.mm(features, query_features)
-        distances, indices = similarity.topk(k, largest=True, sorted=True)
-        candidates = query_labels.view(1, -1).expand(batch_size, -1)
-        retrieved_neighbors = torch.gather(candidates, 1, indices)
-
-        retrieval_one_hot.resize_(batch_size * k, num_classes).zero_()
-        retrieval_one_hot.scatter_(1, retrieved_neighbors.view(-1, 1), 1)
-        distances_transform = distances.clone().div_(T).exp_()
-        probs = torch.sum(
-            torch.mul(
-                retrieval_one_hot.view(batch_size, -1, num_classes),
-                distances_transform.view(batch_size, -1, 1),
-            ),
-            1,
-        )
-        _, predictions = probs.sort(1, True)
-        p = (probs / probs.sum(dim=-1).unsqueeze(-1)).cpu().detach().numpy()
-        test_probs = np.append(test_probs, p, axis=0)
-
-        # find the predictions that match the target
-        correct = predictions.eq(targets.data.view(-1, 1))
-        acc = acc + correct.narrow(1, 0, 1).sum().item()
-        total += targets.size(0)
-
-    acc = acc * 100.0 / total
-    if num_classes == 2:
-        auc = metrics.roc_auc_score(test_labels.cpu(), test_probs[:, 1])
-    else:
-        auc = metrics.roc_auc_score(test_labels.cpu(), test_probs, multi_class="ovr")
-
-    return acc, auc
-
-
 def load_features_and_labels_from_disk(
-    df, features_dir, label_name: str = "label", header: str = "query"
+    df,
+    features_dir,
+    label_name: str = "label",
+    header: str = "query",
+    num_workers: int = 8,
 ):
-    all_feature_paths = [fp for fp in features_dir.glob("*.pt")]
     df["stem"] = df.filename.apply(lambda x: Path(x).stem)
-    feature_paths = [fp for fp in all_feature_paths if fp.stem in df.stem.values]
-
-    features, labels = [], []
-    with tqdm.tqdm(
-        feature_paths,
-        desc=f"Loading {header} features from disk",
-        unit=" img",
-        leave=True,
-    ) as t:
-        for fp in t:
-            f = torch.load(fp)
-            features.append(f)
-            label = df[df.stem == fp.stem][label_name].values[0]
-            labels.append(label)
+    # one feature per file, labelled by the first matching row
+    df = df.drop_duplicates("stem")
+    if is_feature_store(features_dir):
+        # features written by dino/extract_features.py: join on the store manifest
+        store = FeatureStore(features_dir)
+        manifest = store.manifest().rename(
+            columns={"index": "feature_index", "name": "stem"}
+        )
+        df = df.merge(manifest, on="stem", how="inner")
+        store.check_written(df.feature_index.values)
+        print(f"Loading {len(df)} {header} features from {features_dir}")
+        features = store.get_batch(df.feature_index.values).float()
+        features = nn.functional.normalize(features, dim=1, p=2)
+        labels = torch.tensor(df[label_name].values).long()
+        return features, labels
+
+    # single directory listing, joined with the csv rows on file stem
+    with os.scandir(features_dir) as it:
+        feature_paths = pd.DataFrame(
+            [(Path(e.name).stem, e.path) for e in it if e.name.endswith(".pt")],
+            columns=["stem", "feature_path"],
+        )
+    df = df.merge(feature_paths, on="stem", how="inner")
+    assert len(df) > 0, f"no {header} feature found in {features_dir}"
+
+    start_time = time.time()
+    paths = df.feature_path.values
+    first = torch.load(paths[0])
+    features = torch.empty((len(df), *first.shape), dtype=first.dtype)
+    features[0] = first
+
+    def load(i):
+        features[i] = torch.load(paths[i])
+
+    # torch.load mostly waits on file reads, threads overlap them
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        list(
+            tqdm.tqdm(
+                pool.map(load, range(1, len(df))),
+                desc=f"Loading {header} features from disk",
+                unit=" img",
+                total=len(df) - 1,
+                leave=True,
+            )
+        )
+    elapsed = time.time() - start_time
+    print(
+        f"Loaded {len(df)} {header} features in {elapsed:.1f}s ({len(df) / max(elapsed, 1e-6):.0f} features/s)"
+    )
 
-    features = torch.stack(features)
     features = nn.functional.normalize(features, dim=1, p=2)
-    labels = torch.tensor(labels).long()
+    labels = torch.tensor(df[label_name].values).long()
 
     return features, labels
 
@@ -329,9 +463,11 @@ def load_features_and_labels_from_disk(
     config_name="knn",
 )
 def main(cfg: DictConfig):
-    run_distributed = torch.cuda.device_count() > 1
+    # nccl across gpus, or gloo when running several processes on cpu
+    backend = distributed_backend(cfg.speed.device)
+    run_distributed = backend is not None
     if run_distributed:
-        torch.distributed.init_process_group(backend="nccl")
+        torch.distributed.init_process_group(backend=backend)
         gpu_id = int(os.environ["LOCAL_RANK"])
         if gpu_id == 0:
             print("Distributed session successfully initialized")
@@ -351,6 +487,9 @@ def main(cfg: DictConfig):
         run_id = ""
 
     cudnn.benchmark = True
+    device = get_device(cfg.speed.device, gpu_id)
+    if device.type == "cpu":
+        setup_cpu(cfg.speed.num_threads)
 
     output_dir = Path(cfg.output_dir, cfg.experiment_name, run_id)
     if is_main_process():
@@ -363,10 +502,16 @@ def main(cfg: DictConfig):
 
     if cfg.data.features_dir is not None:
         query_features, query_labels = load_features_and_labels_from_disk(
-            query_df, Path(cfg.data.features_dir), header="query"
+            query_df,
+            Path(cfg.data.features_dir),
+            header="query",
+            num_workers=cfg.speed.num_workers,
         )
         test_features, test_labels = load_features_and_labels_from_disk(
-            test_df, Path(cfg.data.features_dir), header="test"
+            test_df,
+            Path(cfg.data.features_dir),
+            header="test",
+            num_workers=cfg.speed.num_workers,
         )
     else:
         # need to extract features !
@@ -395,6 +540,10 @@ def main(cfg: DictConfig):
             use_cuda=cfg.speed.use_cuda,
             num_workers=cfg.speed.num_workers,
             label_name=cfg.label_name,
+            feature_bank_dir=cfg.feature_bank_dir,
+            device=device,
+            bf16=cfg.speed.bf16,
+            channels_last=cfg.speed.channels_last,
         )
 
     if is_main_process():
@@ -402,21 +551,61 @@ def main(cfg: DictConfig):
             torch.unique(test_labels)
         ), "query & test dataset have different number of classes!"
         num_classes = len(torch.unique(query_labels))
-        if cfg.speed.use_cuda:
+        if cfg.speed.use_cuda and device.type == "cuda":
             query_features, query_labels = query_features.cuda(), query_labels.cuda()
             test_features, test_labels = test_features.cuda(), test_labels.cuda()
 
+        index = None
+        if cfg.index.name != "exact":
+            fingerprint = features_fingerprint(query_features)
+            if cfg.index.path and Path(cfg.index.path).is_file():
+                index = load_index(
+                    cfg.index.path,
+                    device=query_features.device,
+                    fingerprint=fingerprint,
+                )
+                if index is None or index.name != cfg.index.name:
+                    print(
+                        f"Index at {cfg.index.path} was not built as {cfg.index.name} on these query features, rebuilding it"
+                    )
+                    index = None
+                else:
+                    print(f"Loaded {cfg.index.name} index from {cfg.index.path}")
+            if index is None:
+                print(f"Building {cfg.index.name} index on query features...")
+                index = build_index(
+                    cfg.index.name,
+                    query_features,
+                    nlist=cfg.index.nlist,
+                    nprobe=cfg.index.nprobe,
+                    m=cfg.index.pq_m,
+                )
+                if cfg.index.path:
+                    save_index(index, cfg.index.path, fingerprint)
+            if cfg.index.name == "ivf_pq" and cfg.index.rerank:
+                index = RerankIndex(index, query_features, cfg.index.rerank)
+            if cfg.index.recall_sample:
+                exact_index = ExactIndex().build(query_features)
+                sample = test_features[: cfg.index.recall_sample]
+                for k in cfg.nb_knn:
+                    recall = recall_at_k(index, exact_index, sample, k)
+                    print(f"{cfg.index.name} recall@{k}: {recall:.4f}")
+
         print("Features are ready!\nStarting kNN classification.")
+        # a single similarity pass serves all values of k
+        knn_results = knn_classifier_multi_k(
+            query_features,
+            query_labels,
+            test_features,
+            test_labels,
+            cfg.nb_knn,
+            cfg.temperature,
+            num_classes,
+            memory_budget=cfg.speed.memory_budget,
+            index=index,
+        )
         for k in cfg.nb_knn:
-            acc, auc = knn_classifier(
-                query_features,
-                query_labels,
-                test_features,
-                test_labels,
-                k,
-                cfg.temperature,
-                num_classes,
-            )
+            acc, auc = knn_results[k]
             print(f"{k}-NN classifier result:")
             print(f"- auc: {auc}")
             print(f"- accuracy: {acc:.2f}%")
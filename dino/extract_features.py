@@ -4,25 +4,47 @@ import wandb
 import torch
 import hydra
 import datetime
-import pandas as pd
 import multiprocessing as mp
 
 from pathlib import Path
 from omegaconf import DictConfig
+from torchvision import transforms
 
-from dino.models import PatchEmbedder
+from dino.models import PatchEmbedder, RegionEmbedder
 from dino.log import initialize_wandb
-from dino.distributed import is_main_process
-from dino.data import ImageFolderWithNameDataset, make_classification_eval_transform
+from dino.distributed import (
+    is_main_process,
+    get_rank,
+    get_world_size,
+    get_device,
+    distributed_backend,
+    setup_cpu,
+    prepare_for_inference,
+    to_device,
+    inference_context,
+)
+from dino.data import (
+    FeatureStoreWriter,
+    ImageFolderWithNameDataset,
+    make_classification_eval_transform,
+    get_decoder,
+)
+from dino.data.augmentations import MaybeToTensor, make_normalize_transform
 
 
-@hydra.main(
-    version_base="1.2.0", config_path="config/feature_extraction", config_name="patch"
-)
+class ReturnIndexDataset(ImageFolderWithNameDataset):
+    def __getitem__(self, idx):
+        img, fname = super(ReturnIndexDataset, self).__getitem__(idx)
+        return idx, img, fname
+
+
+@hydra.main(version_base="1.2.0", config_path="config", config_name="features")
 def main(cfg: DictConfig):
-    run_distributed = torch.cuda.device_count() > 1
+    # nccl across gpus, or gloo when running several processes on cpu
+    backend = distributed_backend(cfg.device)
+    run_distributed = backend is not None
     if run_distributed:
-        torch.distributed.init_process_group(backend="nccl")
+        torch.distributed.init_process_group(backend=backend)
         gpu_id = int(os.environ["LOCAL_RANK"])
         if gpu_id == 0:
             print("Distributed session successfully initialized")
@@ -44,33 +66,83 @@ def main(cfg: DictConfig):
     if run_distributed:
         obj = [run_id]
         torch.distributed.broadcast_object_list(
-            obj, 0, device=torch.device(f"cuda:{gpu_id}")
+            obj, 0, device=get_device(cfg.device, gpu_id)
         )
         run_id = obj[0]
 
-    output_dir = Path(cfg.output_dir, cfg.experiment_name, run_id)
+    if cfg.resume_dir:
+        output_dir = Path(cfg.resume_dir)
+    else:
+        output_dir = Path(cfg.output_dir, cfg.experiment_name, run_id)
     features_dir = Path(output_dir, "features")
     if is_main_process():
-        if output_dir.exists():
+        if output_dir.exists() and not cfg.resume_dir:
             print(f"{output_dir} already exists! deleting it...")
         output_dir.mkdir(parents=True, exist_ok=True)
         features_dir.mkdir(exist_ok=True)
 
-    model = PatchEmbedder(
-        img_size=cfg.img_size,
-        mini_patch_size=cfg.patch_size,
-        pretrain_vit_patch=cfg.pretrain_vit_patch,
-        verbose=(gpu_id in [-1, 0]),
-        img_size_pretrained=cfg.img_size_pretrained,
-    )
+    if cfg.level == "region" and cfg.decoder == "pil_draft":
+        # regions are decoded at full size, then tiled into img_size patches
+        raise ValueError(
+            "decoder 'pil_draft' would decode regions at reduced size, use 'pil' or 'torchvision' when level is 'region'"
+        )
 
-    transform = make_classification_eval_transform()
-    dataset = ImageFolderWithNameDataset(cfg.data_dir, transform)
+    if cfg.level == "patch":
+        model = PatchEmbedder(
+            img_size=cfg.img_size,
+            patch_size=cfg.patch_size,
+            pretrain_vit_patch=cfg.pretrain_vit_patch,
+            verbose=(gpu_id in [-1, 0]),
+            img_size_pretrained=cfg.img_size_pretrained,
+        )
+        transform = make_classification_eval_transform()
+        # one [384] feature vector per image
+        feature_shape = (model.vit_patch.embed_dim,)
+    elif cfg.level == "region":
+        model = RegionEmbedder(
+            region_size=cfg.region_size,
+            img_size=cfg.img_size,
+            patch_size=cfg.patch_size,
+            pretrain_vit_patch=cfg.pretrain_vit_patch,
+            img_size_pretrained=cfg.img_size_pretrained,
+            patch_batch_size=cfg.patch_batch_size,
+            verbose=(gpu_id in [-1, 0]),
+        )
+        transform = transforms.Compose(
+            [
+                MaybeToTensor(),
+                make_normalize_transform(),
+            ]
+        )
+        # one [npatch**2, 384] sequence of patch features per region
+        feature_shape = (model.npatch**2, model.vit_patch.embed_dim)
+    else:
+        raise ValueError(f"level should be 'patch' or 'region', got {cfg.level}")
+
+    dataset = ReturnIndexDataset(
+        cfg.data_dir, transform, loader=get_decoder(cfg.decoder, cfg.img_size)
+    )
 
+    # features are streamed into large preallocated shards, indexed by dataset index
+    # main process creates the store (or reopens it when resuming), other processes then attach to it
+    store_kwargs = {
+        "shape": feature_shape,
+        "length": len(dataset),
+        "dtype": cfg.dtype,
+        "shard_size": cfg.shard_size,
+    }
+    if is_main_process():
+        writer = FeatureStoreWriter(features_dir, **store_kwargs)
     if run_distributed:
-        sampler = torch.utils.data.DistributedSampler(dataset, shuffle=True)
-    else:
-        sampler = torch.utils.data.RandomSampler(dataset)
+        torch.distributed.barrier()
+    if not is_main_process():
+        writer = FeatureStoreWriter(features_dir, **store_kwargs)
+
+    # skip images whose features were already written by a previous (interrupted) run
+    pending = writer.pending()
+    if is_main_process() and len(pending) < len(dataset):
+        print(f"Resuming: {len(dataset)-len(pending)}/{len(dataset)} features found")
+    indices = pending[get_rank() :: get_world_size()].tolist()
 
     num_workers = min(mp.cpu_count(), cfg.num_workers)
     if "SLURM_JOB_CPUS_PER_NODE" in os.environ:
@@ -78,24 +150,21 @@ def main(cfg: DictConfig):
 
     loader = torch.utils.data.DataLoader(
         dataset,
-        sampler=sampler,
+        sampler=indices,
         batch_size=cfg.batch_size,
         num_workers=num_workers,
         shuffle=False,
         drop_last=False,
     )
 
-    if gpu_id == -1:
-        device = torch.device("cuda")
-    else:
-        device = torch.device(f"cuda:{gpu_id}")
-    model = model.to(device, non_blocking=True)
+    device = get_device(cfg.device, gpu_id)
+    if device.type == "cpu":
+        setup_cpu(cfg.num_threads)
+    model = prepare_for_inference(model, device, cfg.channels_last)
 
     if is_main_process():
         print()
 
-    filenames, feature_paths = [], []
-
     with tqdm.tqdm(
         loader,
         desc="Feature Extraction",
@@ -106,50 +175,30 @@ def main(cfg: DictConfig):
         leave=True,
         disable=not (gpu_id in [-1, 0]),
     ) as t1:
-        with torch.no_grad():
+        with inference_context(device, cfg.bf16):
             for i, batch in enumerate(t1):
-                imgs, fnames = batch
-                imgs = imgs.to(device, non_blocking=True)
-                features = model(imgs)
-                for k, f in enumerate(features):
-                    fname = fnames[k]
-                    feature_path = Path(features_dir, f"{fname}.pt")
-                    torch.save(f, feature_path)
-                    filenames.append(fname)
-                    feature_paths.append(feature_path)
+                idx, imgs, _ = batch
+                imgs = to_device(imgs, device, cfg.channels_last)
+                features = model(imgs).float()
+                writer.write(idx.numpy(), features)
                 if cfg.wandb.enable and not run_distributed:
                     wandb.log({"processed": i + imgs.shape[0]})
 
-    features_df = pd.DataFrame.from_dict(
-        {
-            "filename": filenames,
-            "feature_path": feature_paths,
-        }
-    )
-
-    if run_distributed:
-        features_csv_path = Path(output_dir, f"features_{gpu_id}.csv")
-    else:
-        features_csv_path = Path(output_dir, "features.csv")
-    features_df.to_csv(features_csv_path, index=False)
-
+    # wait for every process to be done writing before writing the manifest
+    writer.flush()
     if run_distributed:
         torch.distributed.barrier()
-        if is_main_process():
-            dfs = []
-            for gpu_id in range(torch.cuda.device_count()):
-                fp = Path(output_dir, f"features_{gpu_id}.csv")
-                df = pd.read_csv(fp)
-                dfs.append(df)
-                os.remove(fp)
-            features_df = pd.concat(dfs, ignore_index=True)
-            features_df = features_df.drop_duplicates()
-            features_df.to_csv(Path(output_dir, "features.csv"), index=False)
+    if is_main_process():
+        filenames = [Path(fp).stem for fp, _ in dataset.samples]
+        writer.close(names=filenames)
+        print(f"Features saved at {features_dir}")
+    else:
+        writer.close(finalize=False)
 
     if cfg.wandb.enable and is_main_process() and run_distributed:
-        wandb.log({"processed": len(features_df)})
+        wandb.log({"processed": len(dataset)})
 
 
 if __name__ == "__main__":
-    # python3 -m torch.distributed.run --standalone --nproc_per_node=gpu extract_features_patch.py --config-name 'patch'
+    # python3 -m torch.distributed.run --standalone --nproc_per_node=gpu dino/extract_features.py
     main()
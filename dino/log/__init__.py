@@ -1,2 +1,2 @@
-from .helpers import MetricLogger
+from .helpers import MetricLogger, DeferredMetricLogger
 from .tracker import initialize_wandb, update_log_dict
@@ -1,3 +1,4 @@
+import math
 import tqdm
 import time
 import torch
@@ -185,3 +186,62 @@ class MetricLogger(object):
                 header, total_time_str, total_time / len(iterable)
             )
         )
+
+
+class DeferredMetricLogger(MetricLogger):
+    """
+    MetricLogger which keeps tensor values on device and only copies them to the host
+    every sync_every updates, instead of synchronizing the host with the device at each step.
+    Values of the metrics listed in check_finite are checked when flushing:
+    non-finite values are returned so that the caller can abort, at most sync_every - 1 steps late ;
+    non-finite values of the other metrics are left out of their meters.
+    """
+
+    def __init__(self, delimiter="\t", sync_every=1, check_finite=("loss",)):
+        super().__init__(delimiter=delimiter)
+        self.sync_every = max(1, sync_every)
+        self.check_finite = set(check_finite)
+        self.pending = defaultdict(list)
+        self.pending_steps = 0
+
+    def update(self, **kwargs):
+        for k, v in kwargs.items():
+            if isinstance(v, torch.Tensor):
+                self.pending[k].append(v.detach().reshape(()))
+            else:
+                assert isinstance(v, (float, int))
+                self.meters[k].update(v)
+        self.pending_steps += 1
+        if self.pending_steps >= self.sync_every:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Copy pending values to the host in a single transfer and update the meters.
+        Returns the (name, value) pairs which are not finite.
+        """
+        self.pending_steps = 0
+        if len(self.pending) == 0:
+            return []
+        names = list(self.pending.keys())
+        values = torch.stack(
+            [v.float() for name in names for v in self.pending[name]]
+        ).tolist()
+        non_finite, start = [], 0
+        for name in names:
+            n = len(self.pending[name])
+            for v in values[start : start + n]:
+                if not math.isfinite(v):
+                    if name in self.check_finite:
+                        non_finite.append((name, v))
+                    # other metrics skip non-finite values, e.g. gradient norms of the steps skipped by the fp16 scaler
+                    continue
+                self.meters[name].update(v)
+            start += n
+        self.pending.clear()
+        return non_finite
+
+    def synchronize_between_processes(self, gpu_id):
+        self.flush()
+        super().synchronize_between_processes(gpu_id)
@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 
@@ -8,6 +9,74 @@ from dino.utils import update_state_dict
 from dino.models.vision_transformer import vit_small
 
 
+def _cat(tensors):
+    # crops staged on device are already grouped per resolution: avoid a copy
+    return tensors[0] if len(tensors) == 1 else torch.cat(tensors)
+
+
+class CropStager(object):
+    """
+    Stage multi-crop batches on device with a single host to device transfer.
+    Crops are packed in one (pinned) host buffer, global crops first then local crops grouped by
+    resolution, transferred at once and returned as one tensor per group, e.g. [global crops, local crops].
+    Inputs of MultiCropWrapper can be given in this grouped form: groups are then forwarded without
+    re-concatenating crops, and the teacher can reuse the global crops tensor as is.
+    Two host buffers are used in turn, so that packing a batch never races with the transfer of the previous one.
+    """
+
+    def __init__(self, device, nglobal: int = 2):
+        self.device = torch.device(device)
+        self.nglobal = nglobal
+        self.pin = self.device.type == "cuda"
+        self.buffers = [None, None]
+        self.events = [None, None]
+        self.step = 0
+        self._groups = {}
+
+    def crop_groups(self, crops):
+        key = tuple(tuple(c.shape) for c in crops)
+        if key not in self._groups:
+            groups, start = [(0, min(self.nglobal, len(crops)))], self.nglobal
+            for end in range(start + 1, len(key) + 1):
+                if end == len(key) or key[end][1:] != key[start][1:]:
+                    groups.append((start, end))
+                    start = end
+            self._groups[key] = groups
+        return self._groups[key]
+
+    def _buffer(self, numel: int, dtype: torch.dtype):
+        if not self.pin:
+            return torch.empty(numel, dtype=dtype)
+        i = self.step % 2
+        self.step += 1
+        buffer = self.buffers[i]
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype:
+            buffer = torch.empty(numel, dtype=dtype, pin_memory=True)
+            self.buffers[i] = buffer
+        elif self.events[i] is not None:
+            # wait for the transfer which last read from this buffer
+            self.events[i].synchronize()
+        return buffer
+
+    def __call__(self, crops):
+        groups = self.crop_groups(crops)
+        numel = sum(c.numel() for c in crops)
+        buffer = self._buffer(numel, crops[0].dtype)
+        layout, offset = [], 0
+        for start, end in groups:
+            shape = (sum(c.shape[0] for c in crops[start:end]), *crops[start].shape[1:])
+            n = math.prod(shape)
+            torch.cat(crops[start:end], out=buffer[offset : offset + n].view(shape))
+            layout.append((offset, n, shape))
+            offset += n
+        staged = buffer[:numel].to(self.device, non_blocking=True)
+        if self.pin:
+            event = torch.cuda.Event()
+            event.record()
+            self.events[(self.step - 1) % 2] = event
+        return [staged[offset : offset + n].view(shape) for offset, n, shape in layout]
+
+
 class MultiCropWrapper(nn.Module):
     """
     Perform forward pass separately on each resolution input.
@@ -16,39 +85,90 @@ class MultiCropWrapper(nn.Module):
     forward passes = number of different resolutions used. We then
     concatenate all the output features and run the head forward on these
     concatenated features.
+    With packed=True, tokens of every resolution are packed into rows of the longest
+    sequence length (several short sequences per row, attending only to themselves),
+    so that all crops go through the backbone blocks in a single call.
     """
 
-    def __init__(self, backbone, head):
+    def __init__(self, backbone, head, packed: bool = False):
         super(MultiCropWrapper, self).__init__()
         # disable layers dedicated to ImageNet labels classification
         backbone.fc, backbone.head = nn.Identity(), nn.Identity()
         self.backbone = backbone
         self.head = head
+        self.packed = packed and hasattr(backbone, "prepare_tokens")
+        self._groups = {}
+
+    def crop_groups(self, x):
+        """
+        (start, end) indices of consecutive crops sharing the same resolution,
+        computed once per crop configuration.
+        """
+        key = tuple(inp.shape[-1] for inp in x)
+        if key not in self._groups:
+            groups, start = [], 0
+            for end in range(1, len(key) + 1):
+                if end == len(key) or key[end] != key[start]:
+                    groups.append((start, end))
+                    start = end
+            self._groups[key] = groups
+        return self._groups[key]
 
     def forward(self, x):
         # convert to list
         if not isinstance(x, list):
             x = [x]
-        idx_crops = torch.cumsum(
-            torch.unique_consecutive(
-                torch.tensor([inp.shape[-1] for inp in x]),
-                return_counts=True,
-            )[1],
-            0,
-        )
-        start_idx, output = 0, torch.empty(0).to(x[0].device)
-        for end_idx in idx_crops:
-            _out = self.backbone(torch.cat(x[start_idx:end_idx]))
-            # The output is a tuple with XCiT model. See:
-            # https://github.com/facebookresearch/xcit/blob/master/xcit.py#L404-L405
-            if isinstance(_out, tuple):
-                _out = _out[0]
-            # accumulate outputs
-            output = torch.cat((output, _out))
-            start_idx = end_idx
+        groups = self.crop_groups(x)
+        if self.packed and len(groups) > 1:
+            output = self.packed_forward(x, groups)
+        else:
+            outputs = []
+            for start_idx, end_idx in groups:
+                _out = self.backbone(_cat(x[start_idx:end_idx]))
+                # The output is a tuple with XCiT model. See:
+                # https://github.com/facebookresearch/xcit/blob/master/xcit.py#L404-L405
+                if isinstance(_out, tuple):
+                    _out = _out[0]
+                outputs.append(_out)
+            output = torch.cat(outputs) if len(outputs) > 1 else outputs[0]
         # Run the head forward on the concatenated features.
         return self.head(output)
 
+    def packed_forward(self, x, groups):
+        tokens = [
+            self.backbone.prepare_tokens(_cat(x[start_idx:end_idx]))
+            for start_idx, end_idx in groups
+        ]
+        row_len = max(t.shape[1] for t in tokens)
+        rows, segments, cls_index, nrows_total = [], [], [], 0
+        for t in tokens:
+            b, n, dim = t.shape
+            per_row = row_len // n
+            nrows = math.ceil(b / per_row)
+            # fill the last row with empty sequences, and rows up to row_len with padding tokens
+            t = torch.cat((t, t.new_zeros(nrows * per_row - b, n, dim)))
+            t = t.reshape(nrows, per_row * n, dim)
+            t = nn.functional.pad(t, (0, 0, 0, row_len - per_row * n))
+            rows.append(t)
+            # tokens only attend to tokens of the same sequence ; padding tokens get segment -1
+            segment = torch.arange(per_row, device=t.device).repeat_interleave(n)
+            segment = nn.functional.pad(segment, (0, row_len - per_row * n), value=-1)
+            segments.append(segment.expand(nrows, -1))
+            # position of the [CLS] token of each sequence in the flattened rows
+            seq = torch.arange(b, device=t.device)
+            cls_index.append(
+                (nrows_total + seq // per_row) * row_len + (seq % per_row) * n
+            )
+            nrows_total += nrows
+        x = torch.cat(rows)
+        segments = torch.cat(segments)
+        mask = segments[:, :, None] == segments[:, None, :]
+        for blk in self.backbone.blocks:
+            # stochastic depth is drawn per packed crop, as in the unpacked forward
+            x = blk(x, mask=mask, segments=segments)
+        x = self.backbone.norm(x)
+        return x.reshape(-1, x.shape[-1])[torch.cat(cls_index)]
+
 
 class PatchEmbedder(nn.Module):
     def __init__(
@@ -106,3 +226,53 @@ class PatchEmbedder(nn.Module):
         # x = [B, 3, img_size, img_size]
         feature = self.vit_patch(x).detach().cpu()  # [B, 384]
         return feature
+
+
+class RegionEmbedder(PatchEmbedder):
+    """
+    Tile each [region_size x region_size] region into non-overlapping [img_size x img_size] patches
+    and embed all of them with the patch-level Transformer, as one large batch.
+    patch_batch_size caps the number of patches going through the Transformer at once.
+    """
+
+    def __init__(
+        self,
+        region_size: int = 4096,
+        img_size: int = 256,
+        patch_size: int = 16,
+        pretrain_vit_patch: str = "path/to/pretrained/vit_patch/weights.pth",
+        embed_dim: int = 384,
+        mask_attn_patch: bool = False,
+        img_size_pretrained: Optional[int] = None,
+        patch_batch_size: Optional[int] = None,
+        verbose: bool = True,
+    ):
+        super(RegionEmbedder, self).__init__(
+            img_size=img_size,
+            patch_size=patch_size,
+            pretrain_vit_patch=pretrain_vit_patch,
+            embed_dim=embed_dim,
+            mask_attn_patch=mask_attn_patch,
+            img_size_pretrained=img_size_pretrained,
+            verbose=verbose,
+        )
+        self.img_size = img_size
+        self.npatch = region_size // img_size
+        self.patch_batch_size = patch_batch_size
+
+    def forward(self, x):
+        # x = [B, 3, region_size, region_size]
+        B, nc = x.shape[:2]
+        # [B, 3, npatch, npatch, img_size, img_size], patches are ordered row by row
+        patches = x.unfold(2, self.img_size, self.img_size).unfold(
+            3, self.img_size, self.img_size
+        )
+        patches = patches.permute(0, 2, 3, 1, 4, 5).reshape(
+            -1, nc, self.img_size, self.img_size
+        )  # [B*npatch**2, 3, img_size, img_size]
+        chunk_size = self.patch_batch_size or patches.shape[0]
+        features = torch.cat(
+            [self.vit_patch(chunk) for chunk in patches.split(chunk_size)]
+        )  # [B*npatch**2, 384]
+        features = features.reshape(B, self.npatch**2, -1)  # [B, npatch**2, 384]
+        return features.detach().cpu()
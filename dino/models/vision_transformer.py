@@ -49,10 +49,23 @@ def trunc_normal_(tensor, mean=0.0, std=1.0, a=-2.0, b=2.0):
     return _no_grad_trunc_normal_(tensor, mean, std, a, b)
 
 
-def drop_path(x, drop_prob: float = 0.0, training: bool = False):
+def drop_path(
+    x,
+    drop_prob: float = 0.0,
+    training: bool = False,
+    segments: Optional[torch.Tensor] = None,
+):
     if drop_prob == 0.0 or not training:
         return x
     keep_prob = 1 - drop_prob
+    if segments is not None:
+        # (B, N) rows packing several sequences: one draw per sequence, indexed by segment id
+        random_tensor = keep_prob + torch.rand(
+            segments.shape, dtype=x.dtype, device=x.device
+        )
+        random_tensor.floor_()  # binarize
+        random_tensor = torch.gather(random_tensor, 1, segments.clamp(min=0))
+        return x.div(keep_prob) * random_tensor.unsqueeze(-1)
     shape = (x.shape[0],) + (1,) * (
         x.ndim - 1
     )  # work with diff dim tensors, not just 2D ConvNets
@@ -63,14 +76,15 @@ def drop_path(x, drop_prob: float = 0.0, training: bool = False):
 
 
 class DropPath(nn.Module):
-    """Drop paths (Stochastic Depth) per sample  (when applied in main path of residual blocks)."""
+    """Drop paths (Stochastic Depth) per sample  (when applied in main path of residual blocks).
+    With segments, samples are the sequences packed in each row rather than the rows."""
 
     def __init__(self, drop_prob=None):
         super(DropPath, self).__init__()
         self.drop_prob = drop_prob
 
-    def forward(self, x):
-        return drop_path(x, self.drop_prob, self.training)
+    def forward(self, x, segments: Optional[torch.Tensor] = None):
+        return drop_path(x, self.drop_prob, self.training, segments)
 
 
 class Mlp(nn.Module):
@@ -99,7 +113,19 @@ class Mlp(nn.Module):
         return x
 
 
+ATTENTION_BACKENDS = ["math", "sdpa", "chunked"]
+
+
 class Attention(nn.Module):
+    """
+    Multi-head self-attention with a pluggable backend:
+        - math: explicit softmax(qk^T)v, materializes the (B, heads, N, N) attention matrix
+        - sdpa: torch fused scaled_dot_product_attention (flash / memory-efficient kernels when available)
+        - chunked: processes queries by chunks of chunk_size, never holding more than (B, heads, chunk_size, N) scores
+    The attention matrix is only returned when return_attention=True (computed with the math backend).
+    mask is an optional (B, N) key padding mask or (B, N, N) attention mask, with 0 where attention is not allowed.
+    """
+
     def __init__(
         self,
         dim,
@@ -108,18 +134,83 @@ class Attention(nn.Module):
         qk_scale=None,
         attn_drop=0.0,
         proj_drop=0.0,
+        attn_backend: str = "math",
+        chunk_size: int = 256,
     ):
         super().__init__()
+        assert (
+            attn_backend in ATTENTION_BACKENDS
+        ), f"attn_backend should be one of {ATTENTION_BACKENDS}, got {attn_backend}"
+        if attn_backend == "sdpa" and not hasattr(
+            nn.functional, "scaled_dot_product_attention"
+        ):
+            warnings.warn(
+                "scaled_dot_product_attention requires torch>=2.0, falling back to the chunked attention backend"
+            )
+            attn_backend = "chunked"
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim**-0.5
+        self.attn_backend = attn_backend
+        self.chunk_size = chunk_size
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    @staticmethod
+    def _attn_mask(mask: torch.Tensor):
+        # (B, N) key padding mask -> (B, 1, 1, N) ; (B, N, N) attention mask -> (B, 1, N, N)
+        if mask.dim() == 2:
+            return (mask != 0)[:, None, None, :]
+        return (mask != 0)[:, None, :, :]
+
+    def _scores(self, q, k, mask: Optional[torch.Tensor] = None):
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        if mask is not None:
+            # masked positions get -inf, which becomes zero after softmax
+            attn = attn.masked_fill(~self._attn_mask(mask), float("-inf"))
+        return attn.softmax(dim=-1)
+
+    def _math(self, q, k, v, mask: Optional[torch.Tensor] = None):
+        attn = self.attn_drop(self._scores(q, k, mask))
+        return attn @ v, attn
+
+    def _sdpa(self, q, k, v, mask: Optional[torch.Tensor] = None):
+        attn_mask = None
+        if mask is not None:
+            attn_mask = self._attn_mask(mask)
+        # sdpa scales by head_dim**-0.5 ; rescale queries to honour a custom qk_scale
+        scale_factor = self.scale * q.shape[-1] ** 0.5
+        if scale_factor != 1.0:
+            q = q * scale_factor
+        x = nn.functional.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=attn_mask,
+            dropout_p=self.attn_drop.p if self.training else 0.0,
+        )
+        return x, None
+
+    def _chunked(self, q, k, v, mask: Optional[torch.Tensor] = None):
+        out = []
+        for start in range(0, q.shape[2], self.chunk_size):
+            q_chunk = q[:, :, start : start + self.chunk_size]
+            mask_chunk = mask
+            if mask is not None and mask.dim() == 3:
+                mask_chunk = mask[:, start : start + self.chunk_size]
+            attn = self.attn_drop(self._scores(q_chunk, k, mask_chunk))
+            out.append(attn @ v)
+        return torch.cat(out, dim=2), None
+
+    def forward(
+        self,
+        x,
+        mask: Optional[torch.Tensor] = None,
+        return_attention: bool = False,
+    ):
         B, N, C = x.shape
         qkv = (
             self.qkv(x)
@@ -128,48 +219,32 @@ class Attention(nn.Module):
         )
         q, k, v = qkv[0], qkv[1], qkv[2]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if return_attention or self.attn_backend == "math":
+            x, attn = self._math(q, k, v, mask)
+        elif self.attn_backend == "sdpa":
+            x, attn = self._sdpa(q, k, v, mask)
+        else:
+            x, attn = self._chunked(q, k, v, mask)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x, attn
 
 
 class MaskedAttention(Attention):
-    def forward(self, x, mask):
-        B, seq_length, embed_dim = x.shape
-        qkv = (
-            self.qkv(x)
-            .reshape(B, seq_length, 3, self.num_heads, embed_dim // self.num_heads)
-            .permute(2, 0, 3, 1, 4)
-        )
-        q, k, v = qkv[0], qkv[1], qkv[2]
+    """
+    Attention expecting a (B, N) key padding mask ; kept for backward compatibility,
+    masking is handled natively by every Attention backend.
+    """
 
-        # raw attention scores
-        raw_attn = (
-            q @ k.transpose(-2, -1)
-        ) * self.scale  # (M, nhead, seq_length, seq_length)
-
-        # (B, seq_length)
-        mask_ = mask.unsqueeze(1)  # (B, 1, seq_length)
-        mask_ = mask_.unsqueeze(1).expand(
-            -1, self.num_heads, -1, -1
-        )  # (B, nhead, 1, seq_length)
-        # apply the mask so that masked positions have a large negative number,
-        # which becomes zero after softmax, ensuring they do not contribute to the attention scores
-        masked_attn = raw_attn.masked_fill(mask_ == 0, float("-inf"))
-
-        # apply softmax to get the attention weights. Now the masked positions are 0.
-        attn = masked_attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, seq_length, embed_dim)
-        x = self.proj(x)
-        x = self.proj_drop(x)
-        return x, attn
+    def forward(
+        self,
+        x,
+        mask: Optional[torch.Tensor] = None,
+        return_attention: bool = False,
+    ):
+        return super().forward(x, mask=mask, return_attention=return_attention)
 
 
 class Block(nn.Module):
@@ -186,27 +261,20 @@ class Block(nn.Module):
         act_layer=nn.GELU,
         norm_layer=nn.LayerNorm,
         mask_attn: bool = False,
+        attn_backend: str = "math",
     ):
         super().__init__()
         self.norm1 = norm_layer(dim)
-        if mask_attn:
-            self.attn = MaskedAttention(
-                dim,
-                num_heads=num_heads,
-                qkv_bias=qkv_bias,
-                qk_scale=qk_scale,
-                attn_drop=attn_drop,
-                proj_drop=drop,
-            )
-        else:
-            self.attn = Attention(
-                dim,
-                num_heads=num_heads,
-                qkv_bias=qkv_bias,
-                qk_scale=qk_scale,
-                attn_drop=attn_drop,
-                proj_drop=drop,
-            )
+        attn_layer = MaskedAttention if mask_attn else Attention
+        self.attn = attn_layer(
+            dim,
+            num_heads=num_heads,
+            qkv_bias=qkv_bias,
+            qk_scale=qk_scale,
+            attn_drop=attn_drop,
+            proj_drop=drop,
+            attn_backend=attn_backend,
+        )
         self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
@@ -217,18 +285,57 @@ class Block(nn.Module):
             drop=drop,
         )
 
-    def forward(self, x, return_attention=False, mask: Optional[torch.Tensor] = None):
-        if mask is not None:
-            y, attn = self.attn(self.norm1(x), mask)
-        else:
-            y, attn = self.attn(self.norm1(x))
+    def _drop_path(self, x, segments: Optional[torch.Tensor] = None):
+        if segments is None or not isinstance(self.drop_path, DropPath):
+            return self.drop_path(x)
+        return self.drop_path(x, segments)
+
+    def forward(
+        self,
+        x,
+        return_attention=False,
+        mask: Optional[torch.Tensor] = None,
+        segments: Optional[torch.Tensor] = None,
+    ):
+        """
+        segments is an optional (B, N) tensor of sequence ids for rows packing several sequences
+        (-1 for padding tokens), so that stochastic depth is drawn per sequence.
+        """
+        y, attn = self.attn(self.norm1(x), mask=mask, return_attention=return_attention)
         if return_attention:
             return attn
-        x = x + self.drop_path(y)
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        x = x + self._drop_path(y, segments)
+        x = x + self._drop_path(self.mlp(self.norm2(x)), segments)
         return x
 
 
+class PosEmbedCache(object):
+    """
+    Interpolated positional embeddings, cached per input resolution.
+    Entries are tagged with the pos_embed version counter and storage, so they are recomputed
+    whenever pos_embed is modified in-place (optimizer step, EMA update, weights loading).
+    The cache is bypassed when gradients need to flow back to pos_embed.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, pos_embed: torch.Tensor, key, interpolate: Callable):
+        if torch.is_grad_enabled() and pos_embed.requires_grad:
+            return interpolate()
+        tag = (
+            pos_embed._version,
+            pos_embed.data_ptr(),
+            pos_embed.device,
+            pos_embed.dtype,
+        )
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != tag:
+            entry = (tag, interpolate().detach())
+            self.entries[key] = entry
+        return entry[1]
+
+
 class PatchEmbed(nn.Module):
     """Image to Patch Embedding"""
 
@@ -267,6 +374,7 @@ class VisionTransformer(nn.Module):
         norm_layer: Callable = nn.LayerNorm,
         mask_attn: bool = False,
         img_size_pretrained: Optional[int] = None,
+        attn_backend: str = "math",
     ):
         super().__init__()
         self.embed_dim = embed_dim
@@ -287,6 +395,7 @@ class VisionTransformer(nn.Module):
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
         self.pos_drop = nn.Dropout(p=drop_rate)
+        self.pos_embed_cache = PosEmbedCache()
 
         dpr = [
             x.item() for x in torch.linspace(0, drop_path_rate, depth)
@@ -304,6 +413,7 @@ class VisionTransformer(nn.Module):
                     drop_path=dpr[i],
                     norm_layer=norm_layer,
                     mask_attn=mask_attn,
+                    attn_backend=attn_backend,
                 )
                 for i in range(depth)
             ]
@@ -334,6 +444,12 @@ class VisionTransformer(nn.Module):
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == h:
             return self.pos_embed
+        return self.pos_embed_cache.get(
+            self.pos_embed, (w, h), lambda: self._interpolate_pos_encoding(x, w, h)
+        )
+
+    def _interpolate_pos_encoding(self, x, w, h):
+        N = self.pos_embed.shape[1] - 1
         class_pos_embed = self.pos_embed[:, 0]
         patch_pos_embed = self.pos_embed[:, 1:]
         dim = x.shape[-1]
@@ -504,6 +620,7 @@ class HierarchicalVisionTransformer(nn.Module):
         norm_layer: Callable = nn.LayerNorm,
         mask_attn: bool = False,
         img_size_pretrained: Optional[int] = None,
+        attn_backend: str = "math",
     ):
         super().__init__()
         self.embed_dim = output_embed_dim
@@ -527,6 +644,7 @@ class HierarchicalVisionTransformer(nn.Module):
             torch.zeros(1, num_patches + 1, self.embed_dim)
         )  # [1, 196+1, 192]
         self.pos_drop = nn.Dropout(p=drop_rate)
+        self.pos_embed_cache = PosEmbedCache()
 
         dpr = [
             x.item() for x in torch.linspace(0, drop_path_rate, depth)
@@ -544,6 +662,7 @@ class HierarchicalVisionTransformer(nn.Module):
                     drop_path=dpr[i],
                     norm_layer=norm_layer,
                     mask_attn=mask_attn,
+                    attn_backend=attn_backend,
                 )
                 for i in range(depth)
             ]
@@ -577,6 +696,12 @@ class HierarchicalVisionTransformer(nn.Module):
         )  # self.pos_embed = [1, 1+196, 192] -> N = 196 (when patch_size = 256 and img_size = 4096)
         if npatch_sq == N and w == h:
             return self.pos_embed
+        return self.pos_embed_cache.get(
+            self.pos_embed, (w, h), lambda: self._interpolate_pos_encoding(x, w, h)
+        )
+
+    def _interpolate_pos_encoding(self, x, w, h):
+        N = self.pos_embed.shape[1] - 1
         class_pos_embed = self.pos_embed[:, 0]  # [1, 192]
         patch_pos_embed = self.pos_embed[:, 1:]  # [1, N, 192]
         dim = x.shape[-1]  # dim = 192
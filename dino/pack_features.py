@@ -0,0 +1,57 @@
+import tqdm
+import torch
+import hydra
+import multiprocessing as mp
+
+from pathlib import Path
+from omegaconf import DictConfig
+from concurrent.futures import ThreadPoolExecutor
+
+from dino.data import FeatureStoreWriter
+
+
+@hydra.main(version_base="1.2.0", config_path="config", config_name="pack_features")
+def main(cfg: DictConfig):
+    # sort files so that resuming an interrupted conversion maps files to the same entries
+    feature_paths = sorted(Path(cfg.features_dir).glob("*.pt"))
+    assert len(feature_paths) > 0, f"no .pt file found in {cfg.features_dir}"
+    shape = torch.load(feature_paths[0]).shape
+    print(f"Packing {len(feature_paths)} region features of shape {list(shape)}")
+
+    writer = FeatureStoreWriter(
+        cfg.output_dir,
+        shape,
+        len(feature_paths),
+        dtype=cfg.dtype,
+        shard_size=cfg.shard_size,
+    )
+    pending = writer.pending()
+    if len(pending) < len(feature_paths):
+        print(f"Resuming: {len(feature_paths)-len(pending)} regions already packed")
+
+    num_workers = min(mp.cpu_count(), cfg.num_workers)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        with tqdm.tqdm(
+            range(0, len(pending), cfg.batch_size),
+            desc="Packing features",
+            unit=" region",
+            unit_scale=cfg.batch_size,
+            leave=True,
+        ) as t:
+            for start in t:
+                indices = pending[start : start + cfg.batch_size]
+                features = list(
+                    pool.map(torch.load, [feature_paths[i] for i in indices])
+                )
+                for i, f in zip(indices, features):
+                    assert (
+                        f.shape == shape
+                    ), f"{feature_paths[i]} has shape {list(f.shape)}, expected {list(shape)}"
+                writer.write(indices, torch.stack(features))
+
+    writer.close(names=[fp.stem for fp in feature_paths])
+    print(f"Packed feature store saved at {cfg.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
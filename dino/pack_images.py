@@ -0,0 +1,54 @@
+import tqdm
+import random
+import hydra
+import multiprocessing as mp
+
+from pathlib import Path
+from omegaconf import DictConfig
+from torchvision import datasets
+from concurrent.futures import ThreadPoolExecutor
+
+from dino.data import ShardWriter
+from dino.data.datasets.image_folder import scan_image_folder
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@hydra.main(version_base="1.2.0", config_path="config", config_name="pack_images")
+def main(cfg: DictConfig):
+    classes, class_to_idx = datasets.folder.find_classes(cfg.data_dir)
+    num_workers = min(mp.cpu_count(), cfg.num_workers)
+    paths, targets = scan_image_folder(
+        cfg.data_dir, class_to_idx, num_threads=num_workers
+    )
+    assert len(paths) > 0, f"no image found in {cfg.data_dir}"
+    samples = list(zip(paths, targets))
+    if cfg.shuffle:
+        # shards are read sequentially, shuffling once here spreads classes over all shards
+        random.Random(cfg.seed).shuffle(samples)
+    print(f"Packing {len(samples)} images from {len(classes)} classes")
+
+    writer = ShardWriter(cfg.output_dir, classes, shard_size=cfg.shard_size)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        with tqdm.tqdm(
+            range(0, len(samples), cfg.batch_size),
+            desc="Packing images",
+            unit=" img",
+            unit_scale=cfg.batch_size,
+            leave=True,
+        ) as t:
+            for start in t:
+                batch = samples[start : start + cfg.batch_size]
+                contents = pool.map(read_bytes, [path for path, _ in batch])
+                for (path, target), data in zip(batch, contents):
+                    writer.write(data, target, ext=Path(path).suffix.lower())
+
+    writer.close()
+    print(f"{len(writer.shards)} shards saved at {cfg.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
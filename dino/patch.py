@@ -16,14 +16,21 @@ import multiprocessing as mp
 
 from pathlib import Path
 from omegaconf import DictConfig
-from torchvision import datasets
+from torchvision import transforms
 
 import dino.models.vision_transformer as vits
 
-from dino.components import DINOLoss, EarlyStoppingDINO
-from dino.data import PatchDataAugmentationDINO
+from dino.components import DINOLoss, TeacherEMA, EarlyStoppingDINO
+from dino.data import (
+    PatchDataAugmentationDINO,
+    TensorPatchDataAugmentationDINO,
+    CachedImageFolder,
+    TarShardDataset,
+    get_decoder,
+    get_loader_kwargs,
+)
 from dino.eval import prepare_data
-from dino.models import MultiCropWrapper
+from dino.models import MultiCropWrapper, CropStager
 from dino.distributed import get_world_size, is_main_process
 from dino.utils import (
     train_one_epoch,
@@ -106,26 +113,70 @@ def main(cfg: DictConfig):
             False,
             num_workers,
             cfg.early_stopping.downstream.label_name,
+            tile_cache_size=cfg.early_stopping.downstream.tile_cache_size,
+            tile_cache_dir=cfg.early_stopping.downstream.tile_cache_dir,
+            loader_kwargs=get_loader_kwargs(cfg.speed.loader, num_workers),
         )
         print(
             f"Tuning data loaded with {len(downstream_query_loader.dataset)} query patches and {len(downstream_test_loader.dataset)} test patches."
         )
 
-    transform = PatchDataAugmentationDINO(
-        cfg.aug.global_crops_scale,
-        cfg.aug.local_crops_scale,
-        cfg.aug.local_crops_number,
-    )
+    batch_transform = None
+    if cfg.aug.backend == "tensor":
+        # workers only decode images, crops are computed for the whole batch on gpu
+        transform = None
+        if cfg.speed.decoder != "torchvision":
+            transform = transforms.PILToTensor()
+        batch_transform = TensorPatchDataAugmentationDINO(
+            cfg.aug.global_crops_scale,
+            cfg.aug.local_crops_scale,
+            cfg.aug.local_crops_number,
+        )
+    elif cfg.aug.backend == "pil":
+        transform = PatchDataAugmentationDINO(
+            cfg.aug.global_crops_scale,
+            cfg.aug.local_crops_scale,
+            cfg.aug.local_crops_number,
+        )
+    else:
+        raise ValueError(f"unknown augmentation backend: {cfg.aug.backend}")
 
     # ============ preparing training data ============
     dataset_loading_start_time = time.time()
-    dataset = datasets.ImageFolder(cfg.data_dir, transform=transform)
+    decoder = get_decoder(cfg.speed.decoder, cfg.speed.decoder_min_size)
+    if cfg.data_format == "shards":
+        dataset = TarShardDataset(
+            cfg.data_dir,
+            transform=transform,
+            loader=decoder,
+            batch_size=cfg.training.batch_size_per_gpu,
+            shuffle_buffer=cfg.speed.shuffle_buffer,
+            seed=cfg.seed,
+            mp_context=cfg.speed.loader.multiprocessing_context,
+        )
+        npatches, cached = dataset.nsamples, ""
+    elif cfg.data_format == "folder":
+        dataset = CachedImageFolder(
+            cfg.data_dir,
+            transform=transform,
+            loader=decoder,
+            cache_dir=cfg.speed.manifest_cache_dir,
+            num_threads=cfg.speed.scan_threads,
+        )
+        npatches = len(dataset)
+        cached = " from cached manifest" if dataset.cache_hit else ""
+    else:
+        raise ValueError(f"unknown data format: {cfg.data_format}")
     dataset_loading_end_time = time.time() - dataset_loading_start_time
     total_time_str = str(datetime.timedelta(seconds=int(dataset_loading_end_time)))
     if is_main_process():
-        print(f"Pretraining data loaded in {total_time_str} ({len(dataset)} patches)")
+        print(
+            f"Pretraining data loaded{cached} in {total_time_str} ({npatches} patches)"
+        )
 
     if cfg.training.pct:
+        if cfg.data_format == "shards":
+            raise ValueError("training.pct is not supported with sharded data")
         nsample = int(cfg.training.pct * len(dataset))
         idxs = random.sample(range(len(dataset)), k=nsample)
         dataset = torch.utils.data.Subset(dataset, idxs)
@@ -134,7 +185,10 @@ def main(cfg: DictConfig):
                 f"Pretraining on {cfg.training.pct*100}% of the data: {len(dataset):,d} samples\n"
             )
 
-    if distributed:
+    if cfg.data_format == "shards":
+        # shuffling and splitting across ranks is done by the dataset itself
+        sampler = None
+    elif distributed:
         sampler = torch.utils.data.DistributedSampler(dataset, shuffle=True)
     else:
         sampler = torch.utils.data.RandomSampler(dataset)
@@ -146,9 +200,8 @@ def main(cfg: DictConfig):
         dataset,
         sampler=sampler,
         batch_size=cfg.training.batch_size_per_gpu,
-        num_workers=num_workers,
-        pin_memory=True,
         drop_last=True,
+        **get_loader_kwargs(cfg.speed.loader, num_workers, max(gpu_id, 0)),
     )
 
     # building student and teacher networks
@@ -158,8 +211,13 @@ def main(cfg: DictConfig):
         img_size=cfg.model.input_size,
         patch_size=cfg.model.patch_size,
         drop_path_rate=cfg.model.drop_path_rate,
+        attn_backend=cfg.model.attn_backend,
+    )
+    teacher = vits.__dict__[cfg.model.arch](
+        img_size=cfg.model.input_size,
+        patch_size=cfg.model.patch_size,
+        attn_backend=cfg.model.attn_backend,
     )
-    teacher = vits.__dict__[cfg.model.arch](img_size=cfg.model.input_size, patch_size=cfg.model.patch_size)
     embed_dim = student.embed_dim
 
     # multi-crop wrapper handles forward with inputs of different resolutions
@@ -171,6 +229,7 @@ def main(cfg: DictConfig):
             use_bn=cfg.model.use_bn_in_head,
             norm_last_layer=cfg.model.norm_last_layer,
         ),
+        packed=cfg.speed.packed_crops,
     )
     teacher = MultiCropWrapper(
         teacher,
@@ -214,6 +273,15 @@ def main(cfg: DictConfig):
     for p in teacher.parameters():
         p.requires_grad = False
 
+    # teacher weights are updated with an exponential moving average of the student weights
+    student_without_ddp = student.module if distributed else student
+    teacher_ema = TeacherEMA(
+        student_without_ddp,
+        teacher_without_ddp,
+        update_every=cfg.training.update_teacher_every,
+        fp32_master=cfg.speed.use_fp16 and cfg.speed.teacher_fp32_master,
+    )
+
     # total number of crops = 2 global crops + local_crops_number
     crops_number = cfg.aug.local_crops_number + 2
     dino_loss = DINOLoss(
@@ -223,6 +291,7 @@ def main(cfg: DictConfig):
         cfg.model.teacher_temp,
         cfg.model.warmup_teacher_temp_epochs,
         cfg.training.nepochs,
+        chunk_size=cfg.speed.loss_chunk_size,
     )
     if distributed:
         dino_loss = dino_loss.to(gpu_id)
@@ -232,6 +301,11 @@ def main(cfg: DictConfig):
     params_groups = get_params_groups(student)
     optimizer = torch.optim.AdamW(params_groups)
 
+    # pack crops in a single host to device transfer
+    crop_stager = None
+    if cfg.speed.stage_crops:
+        crop_stager = CropStager(f"cuda:{gpu_id}" if distributed else "cuda")
+
     # for mixed precision training
     fp16_scaler = None
     if cfg.speed.use_fp16:
@@ -278,6 +352,7 @@ def main(cfg: DictConfig):
             teacher.load_state_dict(snapshot["teacher"])
             optimizer.load_state_dict(snapshot["optimizer"])
             dino_loss.load_state_dict(snapshot["dino_loss"])
+            teacher_ema.load_state_dict(snapshot.get("teacher_ema", {}))
             if fp16_scaler is not None:
                 fp16_scaler.load_state_dict(snapshot["fp16_scaler"])
             if is_main_process():
@@ -293,6 +368,7 @@ def main(cfg: DictConfig):
             optimizer=optimizer,
             fp16_scaler=fp16_scaler,
             dino_loss=dino_loss,
+            teacher_ema=teacher_ema,
         )
         if is_main_process():
             print(f"Resuming training from checkpoint at epoch {epochs_run}")
@@ -327,14 +403,16 @@ def main(cfg: DictConfig):
             if cfg.wandb.enable and is_main_process():
                 log_dict = {"epoch": epoch}
 
-            if distributed:
+            if cfg.data_format == "shards":
+                dataset.set_epoch(epoch)
+            elif distributed:
                 data_loader.sampler.set_epoch(epoch)
 
             # training one epoch of DINO
             train_stats = train_one_epoch(
                 student,
                 teacher,
-                teacher_without_ddp,
+                teacher_ema,
                 dino_loss,
                 data_loader,
                 optimizer,
@@ -347,6 +425,10 @@ def main(cfg: DictConfig):
                 cfg.training.clip_grad,
                 cfg.training.freeze_last_layer,
                 gpu_id,
+                clip_grad_mode=cfg.training.clip_grad_mode,
+                sync_every=cfg.speed.sync_every,
+                crop_stager=crop_stager,
+                batch_transform=batch_transform,
             )
 
             if cfg.wandb.enable and is_main_process():
@@ -359,6 +441,7 @@ def main(cfg: DictConfig):
                     "teacher": teacher.state_dict(),
                     "optimizer": optimizer.state_dict(),
                     "dino_loss": dino_loss.state_dict(),
+                    "teacher_ema": teacher_ema.state_dict(),
                 }
                 if fp16_scaler is not None:
                     snapshot["fp16_scaler"] = fp16_scaler.state_dict()
@@ -385,6 +468,9 @@ def main(cfg: DictConfig):
                     False,
                     cfg.early_stopping.knn.save_features,
                     cfg.early_stopping.knn.use_cuda,
+                    feature_bank_dir=cfg.early_stopping.knn.feature_bank_dir,
+                    update_feature_bank=bool(cfg.early_stopping.save_every)
+                    and epoch % cfg.early_stopping.save_every == 0,
                 )
 
                 if cfg.wandb.enable and is_main_process():
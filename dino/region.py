@@ -18,9 +18,14 @@ from omegaconf import DictConfig
 
 import dino.models.vision_transformer as vits
 
-from dino.components import DINOLoss
-from dino.data import RegionDataAugmentationDINO, HierarchicalPretrainingDataset
-from dino.models import MultiCropWrapper
+from dino.components import DINOLoss, TeacherEMA
+from dino.data import (
+    RegionDataAugmentationDINO,
+    BatchedRegionDataAugmentationDINO,
+    HierarchicalPretrainingDataset,
+    get_loader_kwargs,
+)
+from dino.models import MultiCropWrapper, CropStager
 from dino.distributed import get_world_size, is_main_process
 from dino.utils import (
     train_one_epoch,
@@ -83,13 +88,24 @@ def main(cfg: DictConfig):
     if is_main_process():
         print("Loading data...")
 
-    transform = RegionDataAugmentationDINO(
-        cfg.aug.global_crops_scale,
-        cfg.aug.local_crops_number,
-        cfg.aug.local_crops_scale,
-        cfg.model.input_size,
-        cfg.model.patch_size,
-    )
+    transform, batch_transform = None, None
+    if cfg.aug.batched:
+        # crops are computed for the whole batch on gpu, after collation
+        batch_transform = BatchedRegionDataAugmentationDINO(
+            cfg.aug.global_crops_scale,
+            cfg.aug.local_crops_number,
+            cfg.aug.local_crops_scale,
+            cfg.model.input_size,
+            cfg.model.patch_size,
+        )
+    else:
+        transform = RegionDataAugmentationDINO(
+            cfg.aug.global_crops_scale,
+            cfg.aug.local_crops_number,
+            cfg.aug.local_crops_scale,
+            cfg.model.input_size,
+            cfg.model.patch_size,
+        )
 
     # using custom dataset for our [256 x 384] tensors ("local" features)
     dataset = HierarchicalPretrainingDataset(cfg.data_dir, transform)
@@ -111,9 +127,8 @@ def main(cfg: DictConfig):
         dataset,
         sampler=sampler,
         batch_size=cfg.training.batch_size_per_gpu,
-        num_workers=num_workers,
-        pin_memory=True,
         drop_last=True,
+        **get_loader_kwargs(cfg.speed.loader, num_workers, max(gpu_id, 0)),
     )
     if is_main_process():
         print(f"Pretraining data loaded ({len(dataset)} regions)")
@@ -125,9 +140,12 @@ def main(cfg: DictConfig):
         img_size=cfg.model.input_size,
         patch_size=cfg.model.patch_size,
         drop_path_rate=cfg.model.drop_path_rate,
+        attn_backend=cfg.model.attn_backend,
     )
     teacher = vits.__dict__[cfg.model.arch](
-        img_size=cfg.model.input_size, patch_size=cfg.model.patch_size
+        img_size=cfg.model.input_size,
+        patch_size=cfg.model.patch_size,
+        attn_backend=cfg.model.attn_backend,
     )
     embed_dim = student.embed_dim
 
@@ -140,6 +158,7 @@ def main(cfg: DictConfig):
             use_bn=cfg.model.use_bn_in_head,
             norm_last_layer=cfg.model.norm_last_layer,
         ),
+        packed=cfg.speed.packed_crops,
     )
     teacher = MultiCropWrapper(
         teacher,
@@ -193,6 +212,15 @@ def main(cfg: DictConfig):
     for p in teacher.parameters():
         p.requires_grad = False
 
+    # teacher weights are updated with an exponential moving average of the student weights
+    student_without_ddp = student.module if distributed else student
+    teacher_ema = TeacherEMA(
+        student_without_ddp,
+        teacher_without_ddp,
+        update_every=cfg.training.update_teacher_every,
+        fp32_master=cfg.speed.use_fp16 and cfg.speed.teacher_fp32_master,
+    )
+
     # total number of crops = 2 global crops + local_crops_number
     crops_number = cfg.aug.local_crops_number + 2
     dino_loss = DINOLoss(
@@ -202,6 +230,7 @@ def main(cfg: DictConfig):
         cfg.model.teacher_temp,
         cfg.model.warmup_teacher_temp_epochs,
         cfg.training.nepochs,
+        chunk_size=cfg.speed.loss_chunk_size,
     )
     if distributed:
         dino_loss = dino_loss.to(gpu_id)
@@ -211,6 +240,11 @@ def main(cfg: DictConfig):
     params_groups = get_params_groups(student)
     optimizer = torch.optim.AdamW(params_groups)
 
+    # pack crops in a single host to device transfer
+    crop_stager = None
+    if cfg.speed.stage_crops:
+        crop_stager = CropStager(f"cuda:{gpu_id}" if distributed else "cuda")
+
     # for mixed precision training
     fp16_scaler = None
     if cfg.speed.use_fp16:
@@ -259,6 +293,7 @@ def main(cfg: DictConfig):
             teacher.load_state_dict(snapshot["teacher"])
             optimizer.load_state_dict(snapshot["optimizer"])
             dino_loss.load_state_dict(snapshot["dino_loss"])
+            teacher_ema.load_state_dict(snapshot.get("teacher_ema", {}))
             if fp16_scaler is not None:
                 fp16_scaler.load_state_dict(snapshot["fp16_scaler"])
             print(f"Resuming training from snapshot at Epoch {epochs_run}")
@@ -271,6 +306,7 @@ def main(cfg: DictConfig):
             optimizer=optimizer,
             fp16_scaler=fp16_scaler,
             dino_loss=dino_loss,
+            teacher_ema=teacher_ema,
         )
         print(f"Resuming training from checkpoint at Epoch {epochs_run}")
 
@@ -300,7 +336,7 @@ def main(cfg: DictConfig):
             train_stats = train_one_epoch(
                 student,
                 teacher,
-                teacher_without_ddp,
+                teacher_ema,
                 dino_loss,
                 data_loader,
                 optimizer,
@@ -313,6 +349,10 @@ def main(cfg: DictConfig):
                 cfg.training.clip_grad,
                 cfg.training.freeze_last_layer,
                 gpu_id,
+                clip_grad_mode=cfg.training.clip_grad_mode,
+                sync_every=cfg.speed.sync_every,
+                crop_stager=crop_stager,
+                batch_transform=batch_transform,
             )
 
             if cfg.wandb.enable and is_main_process():
@@ -326,6 +366,7 @@ def main(cfg: DictConfig):
                     "teacher": teacher.state_dict(),
                     "optimizer": optimizer.state_dict(),
                     "dino_loss": dino_loss.state_dict(),
+                    "teacher_ema": teacher_ema.state_dict(),
                 }
                 if fp16_scaler is not None:
                     snapshot["fp16_scaler"] = fp16_scaler.state_dict()
@@ -1,24 +1,39 @@
 import sys
-import math
+import time
 import tqdm
 import torch
 import torch.nn as nn
 
 from pathlib import Path
+from typing import Optional
 from collections import defaultdict
 
 import dino.models.vision_transformer as vits
 
-from dino.log import MetricLogger
-from dino.distributed import is_main_process
-from dino.eval.knn import extract_multiple_features, knn_classifier
+from dino.log import DeferredMetricLogger
+from dino.distributed import is_main_process, prepare_for_inference
+from dino.eval.knn import (
+    extract_multiple_features,
+    knn_classifier,
+    make_knn_transform,
+)
+from dino.eval.feature_bank import FeatureBank, feature_bank_version
 from dino.utils.utils import load_weights, clip_gradients, cancel_gradients_last_layer
 
 
+def stop_if_not_finite(non_finite, it):
+    if len(non_finite) > 0:
+        name, value = non_finite[0]
+        tqdm.tqdm.write(
+            f"{name.capitalize()} is {value} (checked at iteration {it}), stopping training"
+        )
+        sys.exit(1)
+
+
 def train_one_epoch(
     student,
     teacher,
-    teacher_without_ddp,
+    teacher_ema,
     dino_loss,
     data_loader,
     optimizer,
@@ -31,8 +46,18 @@ def train_one_epoch(
     clip_grad,
     freeze_last_layer,
     gpu_id,
+    clip_grad_mode="param",
+    sync_every=1,
+    crop_stager=None,
+    batch_transform=None,
 ):
-    metric_logger = MetricLogger(delimiter="  ")
+    # metrics stay on device and are copied to the host every sync_every iterations
+    metric_logger = DeferredMetricLogger(delimiter="  ", sync_every=sync_every)
+    device = next(student.parameters()).device
+    # time until the first batch is ready, i.e. spawning workers and filling their prefetch queues
+    loader_start_time = time.perf_counter()
+    loader_startup = None
+    it = len(data_loader) * epoch  # bound even if the loader yields no batch
     with tqdm.tqdm(
         data_loader,
         desc=(f"Epoch [{epoch+1}/{nepochs}]"),
@@ -44,6 +69,8 @@ def train_one_epoch(
         disable=not (gpu_id in [-1, 0]),
     ) as t:
         for it, (images, _) in enumerate(t):
+            if loader_startup is None:
+                loader_startup = time.perf_counter() - loader_start_time
             # update weight decay and learning rate according to their schedule
             it = len(data_loader) * epoch + it  # global training iteration
             for i, param_group in enumerate(optimizer.param_groups):
@@ -51,67 +78,71 @@ def train_one_epoch(
                 if i == 0:  # only the first group is regularized
                     param_group["weight_decay"] = wd_schedule[it]
 
-            # move images to gpu
-            if gpu_id == -1:
-                images = [im.cuda(non_blocking=True) for im in images]
+            # move images to device
+            if batch_transform is not None:
+                # crops are computed on device from the uint8 batch, images = [global crops, local crops]
+                images = batch_transform(images.to(device, non_blocking=True))
+                global_crops = images[:1]
+            elif crop_stager is not None:
+                # single transfer, images = [global crops, local crops (grouped by resolution)]
+                images = crop_stager(images)
+                global_crops = images[:1]
             else:
-                device = torch.device(f"cuda:{gpu_id}")
                 images = [im.to(device, non_blocking=True) for im in images]
+                global_crops = images[:2]
             # teacher and student forward passes + compute dino loss
-            with torch.cuda.amp.autocast(fp16_scaler is not None):
+            with torch.autocast(
+                device_type=device.type, enabled=fp16_scaler is not None
+            ):
                 teacher_output = teacher(
-                    images[:2]
+                    global_crops
                 )  # only the 2 global views pass through the teacher
                 student_output = student(images)
                 loss = dino_loss(student_output, teacher_output, epoch)
 
-            if not math.isfinite(loss.item()):
-                tqdm.tqdm.write(
-                    "Loss is {}, stopping training".format(loss.item()), force=True
-                )
-                sys.exit(1)
-
-            # student update
+            # student backward pass
             optimizer.zero_grad()
+            grad_norm = None
             if fp16_scaler is None:
                 loss.backward()
-                if clip_grad:
-                    _ = clip_gradients(student, clip_grad)
-                cancel_gradients_last_layer(epoch, student, freeze_last_layer)
-                optimizer.step()
             else:
                 fp16_scaler.scale(loss).backward()
                 if clip_grad:
                     fp16_scaler.unscale_(
                         optimizer
                     )  # unscale the gradients of optimizer's assigned params in-place
-                    _ = clip_gradients(student, clip_grad)
-                cancel_gradients_last_layer(epoch, student, freeze_last_layer)
+            if clip_grad:
+                grad_norm = clip_gradients(student, clip_grad, mode=clip_grad_mode)
+            cancel_gradients_last_layer(epoch, student, freeze_last_layer)
+
+            # logging ; the loss is checked for non-finite values whenever metrics are flushed
+            metrics = {
+                "loss": loss.detach(),
+                "lr": optimizer.param_groups[0]["lr"],
+                "wd": optimizer.param_groups[0]["weight_decay"],
+            }
+            if grad_norm is not None:
+                # student gradient norm before clipping
+                metrics["grad_norm"] = grad_norm
+            non_finite = metric_logger.update(**metrics)
+            stop_if_not_finite(non_finite, it)
+
+            # student update
+            if fp16_scaler is None:
+                optimizer.step()
+            else:
                 fp16_scaler.step(optimizer)
                 fp16_scaler.update()
 
             # EMA update for the teacher
-            with torch.no_grad():
-                m = momentum_schedule[it]  # momentum parameter
-                if torch.cuda.device_count() > 1:
-                    student_params = student.module.parameters()
-                else:
-                    student_params = student.parameters()
-                for param_q, param_k in zip(
-                    student_params, teacher_without_ddp.parameters()
-                ):
-                    param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
-
-            # logging
-            torch.cuda.synchronize()
-            metric_logger.update(loss=loss.item())
-            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
-            metric_logger.update(wd=optimizer.param_groups[0]["weight_decay"])
+            teacher_ema.update(it, momentum_schedule[it])
 
+    stop_if_not_finite(metric_logger.flush(), it)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes(gpu_id)
     # print("Averaged stats:", metric_logger)
     train_stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    train_stats["loader_startup"] = loader_startup
     return train_stats
 
 
@@ -130,30 +161,43 @@ def tune_one_epoch(
     distributed: bool,
     save_features: bool = False,
     use_cuda: bool = False,
+    feature_bank_dir: Optional[str] = None,
+    update_feature_bank: bool = True,
 ):
     student_model = vits.__dict__[arch](
         patch_size=patch_size, drop_path_rate=drop_path_rate, num_classes=0
     )
     teacher_model = vits.__dict__[arch](patch_size=patch_size, num_classes=0)
     tqdm.tqdm.write(f"Teacher & student models {arch} {patch_size}x{patch_size} built.")
-    student_model.cuda()
-    teacher_model.cuda()
+    # tuning models run on the same device as the model being trained
+    device = next(student.parameters()).device
+    use_cuda = use_cuda and device.type == "cuda"
     tqdm.tqdm.write(f"Loading epoch {epoch} weights...")
     student_weights = student.state_dict()
     teacher_weights = teacher.state_dict()
     load_weights(student_model, student_weights)
     load_weights(teacher_model, teacher_weights)
-    student_model.eval()
-    teacher_model.eval()
+    student_model = prepare_for_inference(student_model, device)
+    teacher_model = prepare_for_inference(teacher_model, device)
 
     # ============ extract student features ============
     tqdm.tqdm.write("Extracting features for query set...")
     query_features, query_labels = extract_multiple_features(
-        student_model, teacher_model, query_dataloader, distributed, use_cuda
+        student_model,
+        teacher_model,
+        query_dataloader,
+        distributed,
+        use_cuda,
+        device=device,
     )
     tqdm.tqdm.write("Extracting features for test set...")
     test_features, test_labels = extract_multiple_features(
-        student_model, teacher_model, test_dataloader, distributed, use_cuda
+        student_model,
+        teacher_model,
+        test_dataloader,
+        distributed,
+        use_cuda,
+        device=device,
     )
 
     teacher_query_features, teacher_test_features = (
@@ -174,6 +218,22 @@ def tune_one_epoch(
         torch.save(query_labels.cpu(), Path(features_dir, "query_labels.pth"))
         torch.save(test_labels.cpu(), Path(features_dir, "test_labels.pth"))
 
+    # keep features in the bank, so that evaluating this checkpoint later is load-only
+    # (update_feature_bank is only set for epochs whose snapshot is saved: others can never be looked up)
+    if feature_bank_dir is not None and update_feature_bank and is_main_process():
+        split_paths = [
+            [loader.dataset.tile_paths[i] for i in range(len(loader.dataset))]
+            for loader in [query_dataloader, test_dataloader]
+        ]
+        for name, model in [("student", student_model), ("teacher", teacher_model)]:
+            bank = FeatureBank(
+                feature_bank_dir, feature_bank_version(model, make_knn_transform())
+            )
+            for paths, feats in zip(
+                split_paths, [query_features[name], test_features[name]]
+            ):
+                bank.add(paths, feats)
+
     results = defaultdict(dict)
     if is_main_process():
         assert len(torch.unique(query_labels)) == len(
@@ -5,6 +5,7 @@ import torch.nn as nn
 import numpy as np
 
 from pathlib import Path
+from typing import Optional
 
 
 def compute_time(start_time, end_time):
@@ -59,16 +60,29 @@ def has_batchnorms(model):
     return False
 
 
-def clip_gradients(model, clip):
-    norms = []
-    for name, p in model.named_parameters():
-        if p.grad is not None:
-            param_norm = p.grad.data.norm(2)
-            norms.append(param_norm.item())
-            clip_coef = clip / (param_norm + 1e-6)
-            if clip_coef < 1:
-                p.grad.data.mul_(clip_coef)
-    return norms
+def clip_gradients(model, clip, mode: str = "param") -> Optional[torch.Tensor]:
+    """
+    Clip gradients without synchronizing the host with the device.
+    mode="param" clips each parameter gradient to norm clip (original DINO behaviour),
+    mode="global" clips the total gradient norm of the model.
+    Returns the total gradient norm before clipping, as a tensor left on device (None without gradients).
+    """
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return None
+    if mode == "global":
+        return nn.utils.clip_grad_norm_(model.parameters(), clip)
+    elif mode != "param":
+        raise ValueError(f"unknown gradient clipping mode: {mode}")
+    if hasattr(torch, "_foreach_norm"):
+        param_norms = torch._foreach_norm(grads, 2)
+    else:
+        param_norms = [g.norm(2) for g in grads]
+    # clip coefficients stay on device: no sync per parameter
+    norms = torch.stack(param_norms)
+    clip_coefs = (clip / (norms + 1e-6)).clamp_(max=1.0)
+    torch._foreach_mul_(grads, list(clip_coefs.unbind(0)))
+    return norms.norm(2)
 
 
 def cancel_gradients_last_layer(epoch, model, freeze_last_layer):